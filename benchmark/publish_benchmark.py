@@ -0,0 +1,194 @@
+# This script is used for measuring the publish path against a local S3 compatible server
+#
+# python3 benchmark/publish_benchmark.py --size 1024 --chunk-sizes 5,15,64 --workers 1,4,8 --output bench.json
+#
+# Without s3_endpoint_url a moto server is started on localhost, set s3_endpoint_url, s3_access_key and
+# s3_secret_key to run against a MinIO server instead
+
+import argparse
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+PUBLISH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "publish")
+sys.path.insert(0, PUBLISH_DIR)
+
+MB = 1024 * 1024
+BENCHMARK_BUCKET = "publish-benchmark"
+# Sparse images hold data in blocks of this size, spread over the image
+SPARSE_BLOCK_SIZE = 4 * MB
+
+
+def create_image(path, kind, size_mb, data_percent):
+    """
+    Create a synthetic raw image
+
+    :param path: path of image
+    :param kind: dense for random data in the whole image, sparse for random data blocks between holes
+    :param size_mb: size of image in MB
+    :param data_percent: percentage of a sparse image that holds data
+    """
+    size = size_mb * MB
+    with open(path, 'wb') as image:
+        image.truncate(size)
+        if kind == "dense":
+            for _ in range(size // MB):
+                image.write(os.urandom(MB))
+            return
+        blocks = size // SPARSE_BLOCK_SIZE
+        data_blocks = max(1, blocks * data_percent // 100)
+        step = blocks / data_blocks
+        for index in range(data_blocks):
+            image.seek(int(index * step) * SPARSE_BLOCK_SIZE)
+            image.write(os.urandom(SPARSE_BLOCK_SIZE))
+
+
+def _proc_value(path, name):
+    with open(path, 'r') as proc_file:
+        for line in proc_file:
+            if line.startswith(name + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def _read_bytes():
+    # Bytes read by read syscalls of the process, publish reads the image with pread only
+    return _proc_value("/proc/self/io", "rchar")
+
+
+def _peak_rss_mb():
+    # ru_maxrss keeps the peak of the parent across fork and exec, VmHWM belongs to this process only
+    return _proc_value("/proc/self/status", "VmHWM") / 1024
+
+
+def run_one(image_path, chunk_size, workers, output_format):
+    """
+    Publish an image once and measure it, runs in its own process so peak RSS belongs to this run only
+    """
+    from sparse_file import SparseReader
+    from upload_image_to_s3 import create_s3_client, publish_image
+
+    with SparseReader(image_path) as reader:
+        data_size = reader.data_size
+    s3_client = create_s3_client(workers + 2)
+    read_before = _read_bytes()
+    cpu_before = time.process_time()
+    result = publish_image(s3_client, image_path, BENCHMARK_BUCKET, f"benchmark/{uuid.uuid4()}", output_format,
+                           workers=workers, chunksize=chunk_size * MB)
+    cpu_seconds = time.process_time() - cpu_before
+    bytes_read = _read_bytes() - read_before
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    s3_client.delete_object(Bucket=BENCHMARK_BUCKET, Key=result["key"])
+    return {
+        "status": result["status"],
+        "seconds": result["seconds"],
+        "verified_seconds": result["verified_seconds"],
+        "mb_per_second": result["size"] / MB / result["seconds"] if result["seconds"] else 0.0,
+        "peak_rss_mb": _peak_rss_mb(),
+        "cpu_seconds": cpu_seconds + children.ru_utime + children.ru_stime,
+        "bytes_read": bytes_read,
+        "read_passes": bytes_read / data_size if data_size else 0.0,
+    }
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_s3_server():
+    """
+    Start a moto server when no S3 endpoint is configured
+
+    :return: server to stop at the end, None when an endpoint is configured
+    """
+    if os.getenv("s3_endpoint_url"):
+        return None
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    port = _free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    os.environ["s3_endpoint_url"] = f"http://127.0.0.1:{port}"
+    os.environ.setdefault("s3_access_key", "benchmark")
+    os.environ.setdefault("s3_secret_key", "benchmark")
+    return server
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the publish path against a local S3 server")
+    parser.add_argument("--size", type=int, default=1024, help="size of synthetic images in MB")
+    parser.add_argument("--kinds", default="dense,sparse", help="comma separated kinds of image, dense or sparse")
+    parser.add_argument("--data-percent", type=int, default=10, help="percentage of a sparse image holding data")
+    parser.add_argument("--chunk-sizes", type=_int_list, default=[5, 15, 64], help="smallest part sizes in MB")
+    parser.add_argument("--workers", type=_int_list, default=[1, 4, 8], help="numbers of upload workers")
+    parser.add_argument("--output-format", default="raw")
+    parser.add_argument("--image-dir", default=None, help="directory of synthetic images, a temporary one by default")
+    parser.add_argument("--output", default="publish_benchmark.json")
+    parser.add_argument("--run-one", nargs=3, metavar=("IMAGE", "CHUNK_SIZE", "WORKERS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        image_path, chunk_size, workers = args.run_one
+        print(json.dumps(run_one(image_path, int(chunk_size), int(workers), args.output_format)))
+        return
+
+    server = start_s3_server()
+    try:
+        from upload_image_to_s3 import create_s3_client
+        s3_client = create_s3_client()
+        try:
+            s3_client.create_bucket(Bucket=BENCHMARK_BUCKET)
+        except s3_client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+        with tempfile.TemporaryDirectory(dir=args.image_dir) as image_dir:
+            runs = []
+            for kind in args.kinds.split(","):
+                image_path = os.path.join(image_dir, f"{kind}.raw")
+                print(f"Create {kind} image of {args.size} MB")
+                create_image(image_path, kind, args.size, args.data_percent)
+                for chunk_size in args.chunk_sizes:
+                    for workers in args.workers:
+                        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--output-format",
+                                                    args.output_format, "--run-one", image_path, str(chunk_size),
+                                                    str(workers)], capture_output=True, text=True, check=True)
+                        run = {"kind": kind, "chunk_size_mb": chunk_size, "workers": workers}
+                        run.update(json.loads(completed.stdout.strip().splitlines()[-1]))
+                        print(f"{kind} chunk {chunk_size} MB workers {workers}: {run['status']} "
+                              f"{run['mb_per_second']:.1f} MB/s rss {run['peak_rss_mb']:.0f} MB "
+                              f"cpu {run['cpu_seconds']:.1f} s passes {run['read_passes']:.2f}")
+                        runs.append(run)
+    finally:
+        if server is not None:
+            server.stop()
+
+    report = {"commit": _git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "size_mb": args.size,
+              "data_percent": args.data_percent, "output_format": args.output_format, "runs": runs}
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results are written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# This script is used for building an image with disk-image-create and a cache of its layers
+# The target root is archived after the root phase and after the post-install phase, each layer is keyed by the
+# hash of the files of the elements, the environment the phases up to it use and the sha256 of the upstream base
+# image in its SHA256SUMS. A build restores the deepest layer whose key matches and runs only the phases after it
+#
+# ELEMENTS_PATH=disk-image-builder/elements OS_IMAGE_NAME=Ubuntu-22.04 python3 build/build_image.py
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from importlib.metadata import version
+from build_profile import profile_build
+from diskimage_builder.element_dependencies import get_elements
+from diskimage_builder.paths import get_path
+
+CACHE_ELEMENT = "layer-cache"
+# Phases held by each layer, in build order
+LAYERS = {
+    "root": ("root.d",),
+    "install": ("root.d", "extra-data.d", "pre-install.d", "install.d", "post-install.d"),
+}
+# Files of an element which are used only after the post-install phase or not at all by the build
+LATE_ENTRIES = ("post-root.d", "block-device.d", "pre-finalise.d", "finalise.d", "cleanup.d", "test-elements",
+                "tests", "README.rst", "README.md", "__init__.py", "__pycache__")
+# Files of an element which are used up to the root phase
+ROOT_ENTRIES = ("root.d", "environment.d", "bin", "element-deps", "element-provides")
+# Variables of the build which do not change the image
+IGNORED_VARIABLES = ("DIB_IMAGE_CACHE", "DIB_LOCKFILES", "DIB_DEBUG_TRACE", "DIB_IMAGE_CACHE_MAX_SIZE",
+                     "DIB_IMAGE_CACHE_MAX_AGE", "DIB_IMAGE_CACHE_GRACE")
+# Element whose root phase extracts an upstream base image, its environment.d sets the url of the image
+BASE_IMAGE_ELEMENT = "custom-ubuntu"
+
+
+def _hash_entry(entry_hash, path, relative_path):
+    if os.path.islink(path):
+        entry_hash.update(f"link {relative_path} {os.readlink(path)}\n".encode())
+    elif os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name == "__pycache__":
+                continue
+            _hash_entry(entry_hash, os.path.join(path, name), os.path.join(relative_path, name))
+    else:
+        executable = os.access(path, os.X_OK)
+        entry_hash.update(f"file {relative_path} {executable}\n".encode())
+        with open(path, 'rb') as entry_file:
+            for block in iter(lambda: entry_file.read(1024 * 1024), b""):
+                entry_hash.update(block)
+
+
+def hash_element(element_path, entries=None):
+    """
+    This function used for hashing the files of an element
+
+    :param element_path: path of element
+    :param entries: top level entries to hash, every entry used until the post-install phase by default
+    :return: sha256 of the entries
+    """
+    element_hash = hashlib.sha256()
+    for name in sorted(os.listdir(element_path)):
+        if entries is not None and name not in entries:
+            continue
+        if entries is None and name in LATE_ENTRIES:
+            continue
+        _hash_entry(element_hash, os.path.join(element_path, name), name)
+    return element_hash.hexdigest()
+
+
+def build_environment():
+    """
+    Variables of disk-image-builder which change the image
+    """
+    environment = {name: value for name, value in os.environ.items()
+                   if name.startswith("DIB_") and name not in IGNORED_VARIABLES}
+    environment["ARCH"] = os.getenv("ARCH", "")
+    environment["diskimage-builder"] = version("diskimage-builder")
+    return environment
+
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as image_file:
+        for block in iter(lambda: image_file.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def base_image_checksum(elements):
+    """
+    This function used for finding the sha256 of the upstream base image of the root phase, so a new base image
+    published under the same name builds the root layer again. The url of the image is read from the environment.d
+    of the elements like disk-image-create does, and the sha256 from its SHA256SUMS, the cached SHA256SUMS of
+    base-image-cache is read when DIB_OFFLINE is set
+
+    :param elements: list of (name, path) of the elements of the image
+    :return: sha256 of the base image, None when the image has no upstream base image
+    """
+    if BASE_IMAGE_ELEMENT not in dict(elements):
+        return None
+    if os.getenv("DIB_LOCAL_IMAGE"):
+        return _file_sha256(os.environ["DIB_LOCAL_IMAGE"])
+    # disk-image-create sources the environment.d files of all elements ordered by their name
+    environment_files = sorted((name, os.path.join(path, "environment.d", name)) for _, path in elements
+                               if os.path.isdir(os.path.join(path, "environment.d"))
+                               for name in os.listdir(os.path.join(path, "environment.d")))
+    script = "".join(f'source "{path}" >&2\n' for _, path in environment_files)
+    script += 'echo "$BASE_IMAGE_FILE"; echo "$SHA256SUMS"; echo "${DIB_IMAGE_CACHE:-$HOME/.cache/image-create}"\n'
+    output = subprocess.run(["bash", "-c", script], check=True, capture_output=True, text=True).stdout
+    base_image_file, sums_url, image_cache = output.splitlines()[-3:]
+    sums_path = os.path.join(image_cache, f"{base_image_file}.SHA256SUMS")
+    if os.getenv("DIB_OFFLINE") and os.path.exists(sums_path):
+        with open(sums_path, 'r') as sums_file:
+            sums = sums_file.read()
+    else:
+        with urllib.request.urlopen(sums_url, timeout=60) as response:
+            sums = response.read().decode()
+    for line in sums.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1].lstrip("*") == base_image_file:
+            return parts[0].lower()
+    raise ValueError(f"{base_image_file} is not in {sums_url}")
+
+
+def layer_keys(elements):
+    """
+    This function used for calculating the key of each layer
+
+    :param elements: list of (name, path) of the elements of the image
+    :return: dict of layer name to key
+    """
+    root = {"elements": {name: hash_element(path, ROOT_ENTRIES) for name, path in elements},
+            "environment": build_environment(), "base_image": base_image_checksum(elements)}
+    root_key = hashlib.sha256(json.dumps(root, sort_keys=True).encode()).hexdigest()
+    install = {"root": root_key, "elements": {name: hash_element(path) for name, path in elements}}
+    install_key = hashlib.sha256(json.dumps(install, sort_keys=True).encode()).hexdigest()
+    return {"root": root_key, "install": install_key}
+
+
+def layer_path(cache_dir, image_name, layer, key):
+    return os.path.join(cache_dir, f"{image_name}-{layer}-{key[:32]}.tar.zst")
+
+
+def build_overlay(overlay_dir, elements, layer):
+    """
+    This function used for creating a copy of the element tree without the hooks of the phases a layer holds,
+    entries of the elements are linked to the original ones
+
+    :param overlay_dir: directory of the copy, it is put first in ELEMENTS_PATH so it overrides the originals
+    :param elements: list of (name, path) of the elements of the image
+    :param layer: restored layer
+    """
+    for name, path in elements:
+        if name == CACHE_ELEMENT:
+            continue
+        element_dir = os.path.join(overlay_dir, name)
+        os.makedirs(element_dir)
+        for entry in os.listdir(path):
+            if entry not in LAYERS[layer]:
+                os.symlink(os.path.join(path, entry), os.path.join(element_dir, entry))
+
+
+def touch_layers(paths):
+    """
+    This function used for marking the layers of a build as used now, the modification time of a layer is the time
+    it was last used and orders the eviction. A layer gets a later time than the layers built on it, so eviction
+    never keeps a layer without the one it is built on
+
+    :param paths: dict of layer name to path of layer
+    """
+    now = time.time()
+    for depth, layer in enumerate(reversed(list(LAYERS))):
+        if os.path.exists(paths[layer]):
+            used = now + depth * 0.001
+            os.utime(paths[layer], (used, used))
+
+
+def evict_layers(cache_dir, max_size):
+    """
+    This function used for deleting the least recently used layers until the cache fits in max_size
+
+    :param cache_dir: directory of layers
+    :param max_size: size limit of the cache in bytes
+    """
+    layers = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(".tar.zst"):
+            layers.append((os.stat(path).st_mtime, os.path.getsize(path), path))
+        elif ".tar.zst.tmp." in name and os.stat(path).st_mtime < time.time() - 24 * 3600:
+            # Left by a build which was killed while it took a snapshot
+            os.unlink(path)
+    total = sum(size for _, size, _ in layers)
+    for _, size, path in sorted(layers):
+        if total <= max_size:
+            break
+        print(f"Evict layer {path}")
+        os.unlink(path)
+        total -= size
+
+
+def build_image(image_name, output_path, image_type, cache_dir, max_cache_size, profile_path=None):
+    """
+    :param image_name: element of the image, e.g. Ubuntu-22.04
+    :param output_path: path of the image without extension
+    :param image_type: type of the image for disk-image-create
+    :param cache_dir: directory of layers
+    :param max_cache_size: size limit of the cache in bytes
+    :param profile_path: path of the profile of the build without extension, None to not profile it
+    :return: dict with the restored layer and keys
+    """
+    base_elements_path = os.environ["ELEMENTS_PATH"]
+    elements_path = f"{base_elements_path}:{get_path('elements')}"
+    elements = get_elements([image_name, CACHE_ELEMENT], elements_path)
+    keys = layer_keys(elements)
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = {layer: layer_path(cache_dir, image_name, layer, key) for layer, key in keys.items()}
+    restored = next((layer for layer in reversed(list(LAYERS)) if os.path.exists(paths[layer])), None)
+    result = {"image": image_name, "keys": keys, "restored": restored, "seconds": None}
+    env = dict(os.environ)
+    # Only the layers after the restored one are taken by this build, the phases of the others do not run
+    restored_depth = list(LAYERS).index(restored) if restored is not None else -1
+    for depth, layer in enumerate(LAYERS):
+        snapshot = depth > restored_depth and not os.path.exists(paths[layer])
+        env[f"LAYER_CACHE_{layer.upper()}_SNAPSHOT"] = paths[layer] if snapshot else ""
+    with tempfile.TemporaryDirectory(prefix="elements-") as overlay_dir:
+        if restored is not None:
+            print(f"Restore layer {restored} {paths[restored]}")
+            touch_layers(paths)
+            build_overlay(overlay_dir, elements, restored)
+            env["LAYER_CACHE_RESTORE"] = paths[restored]
+            env["ELEMENTS_PATH"] = f"{overlay_dir}:{base_elements_path}"
+        else:
+            print("No layer of the image is cached, the image is built from scratch")
+            env["LAYER_CACHE_RESTORE"] = ""
+        start = time.monotonic()
+        command = ["disk-image-create", "-n", image_name, CACHE_ELEMENT, "-o", output_path, "-t", image_type]
+        if profile_path is not None:
+            profile = profile_build(command, env, image_name, elements, profile_path)
+            result["slowest_hooks"] = [f"{hook['phase']}/{hook['hook']}" for hook in profile["hooks"][:5]]
+        else:
+            subprocess.run(command, env=env, check=True)
+        result["seconds"] = time.monotonic() - start
+    # Layers taken by the build are written after the layers they are built on
+    touch_layers(paths)
+    evict_layers(cache_dir, max_cache_size)
+    return result
+
+
+if __name__ == "__main__":
+    OS_IMAGE_NAME = os.getenv("OS_IMAGE_NAME")
+    OUTPUT_DIR = os.getenv("output_dir", "/var/os-images")
+    IMAGE_TYPE = os.getenv("image_type", "raw")
+    LAYER_CACHE_DIR = os.getenv("layer_cache_dir", "/var/cache/cloud-image-builder/layers")
+    # Size limit of the layer cache in GB
+    LAYER_CACHE_SIZE = float(os.getenv("layer_cache_size", "50"))
+    REPORT_PATH = os.getenv("build_report_path", "build_report.json")
+    # Path of the profile of the build without extension, empty to not profile it
+    PROFILE_PATH = os.getenv("build_profile_path", "build_profile")
+
+    if os.getenv("ELEMENTS_PATH") is None:
+        print("ELEMENTS_PATH should be set")
+        sys.exit(1)
+    if shutil.which("zstd") is None:
+        print("zstd is needed for the layer cache")
+        sys.exit(1)
+    build_result = build_image(OS_IMAGE_NAME, os.path.join(OUTPUT_DIR, OS_IMAGE_NAME), IMAGE_TYPE, LAYER_CACHE_DIR,
+                               int(LAYER_CACHE_SIZE * 1024 ** 3), PROFILE_PATH or None)
+    print(f"Image {OS_IMAGE_NAME} is built in {build_result['seconds']:.1f}s, restored layer: "
+          f"{build_result['restored']}")
+    with open(REPORT_PATH, 'w') as report_file:
+        json.dump(build_result, report_file, indent=2)
@@ -0,0 +1,184 @@
+# This module is used for profiling a disk-image-create build by phase, element and hook
+# dib-run-parts prints a line when a hook starts and when it completes, the output of the build is read line by line
+# and the wall time, the bytes received from the network and the disk I/O of the host are sampled at these lines.
+# The network and disk counters are of the whole host, the build should be the only job of the runner
+#
+# The profile is written as folded stacks of milliseconds for flamegraph.pl or speedscope, and as a JSON summary
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+HOOK_RUNNING = re.compile(r"dib-run-parts Running (\S+)")
+HOOK_COMPLETED = re.compile(r"dib-run-parts (\S+) completed")
+COUNTERS = ("seconds", "downloaded_bytes", "read_bytes", "written_bytes")
+# Time of the build outside of the hooks of elements
+FRAMEWORK = "disk-image-create"
+# Block devices which are not disks, or which are counted again on the disk under them
+VIRTUAL_DEVICES = ("loop", "ram", "zram", "dm-", "md", "nbd", "sr")
+SECTOR_SIZE = 512
+
+
+def read_counters():
+    """
+    This function used for reading the counters of the host
+
+    :return: dict of seconds, downloaded_bytes, read_bytes and written_bytes
+    """
+    counters = {"seconds": time.monotonic(), "downloaded_bytes": 0, "read_bytes": 0, "written_bytes": 0}
+    with open("/proc/net/dev", 'r') as net_dev:
+        for line in net_dev.readlines()[2:]:
+            interface, values = line.split(":", 1)
+            if interface.strip() != "lo":
+                counters["downloaded_bytes"] += int(values.split()[0])
+    disks = [name for name in os.listdir("/sys/block") if not name.startswith(VIRTUAL_DEVICES)]
+    with open("/proc/diskstats", 'r') as diskstats:
+        for line in diskstats:
+            fields = line.split()
+            if fields[2] in disks:
+                counters["read_bytes"] += int(fields[5]) * SECTOR_SIZE
+                counters["written_bytes"] += int(fields[9]) * SECTOR_SIZE
+    return counters
+
+
+def hook_elements(elements):
+    """
+    This function used for finding the element of each hook, disk-image-create does not allow two elements
+    to have the same hook in a phase
+
+    :param elements: list of (name, path) of the elements of the image
+    :return: dict of (phase, hook) to element name
+    """
+    hooks = dict()
+    for name, path in elements:
+        for phase in os.listdir(path):
+            phase_path = os.path.join(path, phase)
+            if phase.endswith(".d") and os.path.isdir(phase_path):
+                for hook in os.listdir(phase_path):
+                    hooks[(phase, hook)] = name
+    return hooks
+
+
+class BuildProfile:
+    """
+    This class used for attributing the counters of a build to its hooks, the counters between hooks are
+    attributed to disk-image-create
+    """
+
+    def __init__(self, image_name, elements):
+        """
+        :param image_name: name of the image
+        :param elements: list of (name, path) of the elements of the image
+        """
+        self.image_name = image_name
+        self._hooks = hook_elements(elements)
+        self.records = []
+        self._current = None
+        self._last = None
+        self._start = None
+
+    def _add(self, phase, element, hook, counters):
+        self.records.append(dict({"phase": phase, "element": element, "hook": hook},
+                                 **{name: counters[name] - self._last[name] for name in COUNTERS}))
+        self._last = counters
+
+    def start(self):
+        self._start = self._last = read_counters()
+
+    def line(self, text):
+        """
+        Handle a line of the output of the build
+        """
+        running = HOOK_RUNNING.search(text)
+        completed = HOOK_COMPLETED.search(text)
+        if running is None and completed is None:
+            return
+        counters = read_counters()
+        if running is not None:
+            if self._current is not None:
+                # The hook failed to report its end
+                self._add(*self._current, counters)
+            hook_path = running.group(1)
+            phase = os.path.basename(os.path.dirname(hook_path))
+            hook = os.path.basename(hook_path)
+            self._add(FRAMEWORK, FRAMEWORK, FRAMEWORK, counters)
+            self._current = (phase, self._hooks.get((phase, hook), "unknown"), hook)
+        elif self._current is not None and completed.group(1) == self._current[2]:
+            self._add(*self._current, counters)
+            self._current = None
+
+    def finish(self):
+        counters = read_counters()
+        if self._current is not None:
+            self._add(*self._current, counters)
+            self._current = None
+        self._add(FRAMEWORK, FRAMEWORK, FRAMEWORK, counters)
+
+    def folded(self):
+        """
+        :return: folded stacks of image;phase;element;hook with the milliseconds of each
+        """
+        stacks = dict()
+        for record in self.records:
+            if record["phase"] == FRAMEWORK:
+                stack = f"{self.image_name};{FRAMEWORK}"
+            else:
+                stack = f"{self.image_name};{record['phase']};{record['element']};{record['hook']}"
+            stacks[stack] = stacks.get(stack, 0) + record["seconds"] * 1000
+        return "".join(f"{stack} {round(milliseconds)}\n" for stack, milliseconds in stacks.items())
+
+    def summary(self):
+        """
+        :return: dict with the counters of the build by phase, element and hook
+        """
+        def total(key):
+            totals = dict()
+            for record in self.records:
+                counters = totals.setdefault(record[key], dict.fromkeys(COUNTERS, 0))
+                for name in COUNTERS:
+                    counters[name] += record[name]
+            return totals
+
+        hooks = sorted(self.records, key=lambda record: record["seconds"], reverse=True)
+        return {"image": self.image_name, "seconds": sum(record["seconds"] for record in self.records),
+                "phases": total("phase"), "elements": total("element"),
+                "hooks": [hook for hook in hooks if hook["phase"] != FRAMEWORK]}
+
+
+def profile_build(command, env, image_name, elements, profile_path):
+    """
+    This function used for running a build and writing its profile, the profile is written when the build
+    fails too
+
+    :param command: disk-image-create command
+    :param env: environment of the build
+    :param image_name: name of the image
+    :param elements: list of (name, path) of the elements of the image
+    :param profile_path: path of the profile without extension, .folded and .json are written
+    :return: summary of the profile
+    """
+    profile = BuildProfile(image_name, elements)
+    profile.start()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                               errors="replace", bufsize=1)
+    with process.stdout:
+        for line in process.stdout:
+            sys.stdout.write(line)
+            profile.line(line)
+    returncode = process.wait()
+    profile.finish()
+    summary = profile.summary()
+    with open(profile_path + ".folded", 'w') as folded_file:
+        folded_file.write(profile.folded())
+    with open(profile_path + ".json", 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print("Slowest hooks of the build:")
+    for hook in summary["hooks"][:10]:
+        print(f"{hook['seconds']:8.1f}s {hook['phase']}/{hook['hook']} ({hook['element']}) "
+              f"{hook['downloaded_bytes'] / 1024 ** 2:.0f} MB downloaded")
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    return summary
@@ -0,0 +1,175 @@
+# This script is used for shrinking a raw image after it is built, before it is staged and published
+# The filesystems of the image are trimmed through a loop device, or filled with zeros where discard does not
+# work, then the zero regions of the file are turned into holes and the file is optionally truncated after its
+# last partition. Uploads and hashes skip holes, so they only touch the live data of the image
+#
+# OS_IMAGE_NAME=Ubuntu-22.04 python3 build/shrink_image.py
+
+import json
+import os
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+
+SECTOR_SIZE = 512
+MB = 1024 * 1024
+# Filesystems which are mounted to be trimmed or filled with zeros, other partitions are left as they are
+FILESYSTEMS = ("ext2", "ext3", "ext4", "xfs", "btrfs", "vfat")
+# Sectors the backup GPT takes at the end of the disk
+GPT_BACKUP_SECTORS = 33
+
+
+def allocated_size(image_path):
+    return os.stat(image_path).st_blocks * 512
+
+
+def _sudo(*command, check=True):
+    return subprocess.run(["sudo", *command], check=check, capture_output=True, text=True)
+
+
+def partitions_end(image_path):
+    """
+    This function used for finding the end of the last partition of a GPT or MBR image
+
+    :return: (offset in bytes after the last partition, True if the image has a GPT)
+    """
+    with open(image_path, 'rb') as image_file:
+        mbr = image_file.read(SECTOR_SIZE)
+        header = image_file.read(SECTOR_SIZE)
+        if header[:8] == b"EFI PART":
+            entries_lba, entry_count, entry_size = struct.unpack_from("<QII", header, 72)
+            image_file.seek(entries_lba * SECTOR_SIZE)
+            entries = image_file.read(entry_count * entry_size)
+            last_lba = 0
+            for index in range(entry_count):
+                entry = entries[index * entry_size:(index + 1) * entry_size]
+                if entry[:16] == bytes(16):  # unused entry
+                    continue
+                last_lba = max(last_lba, struct.unpack_from("<Q", entry, 40)[0])
+            return (last_lba + 1) * SECTOR_SIZE, True
+    if mbr[510:512] != b"\x55\xaa":
+        raise ValueError(f"{image_path} has no partition table")
+    end = 0
+    for index in range(4):
+        start, count = struct.unpack_from("<II", mbr, 446 + index * 16 + 8)
+        end = max(end, (start + count) * SECTOR_SIZE)
+    return end, False
+
+
+def _trim(mount_dir, mode):
+    """
+    Trim a mounted filesystem, or fill its free space with zeros
+
+    :return: bytes trimmed, None when the free space was filled with zeros
+    """
+    if mode in ("trim", "auto"):
+        trimmed = _sudo("fstrim", "-v", mount_dir, check=mode == "trim")
+        if trimmed.returncode == 0:
+            match = re.search(r"\((\d+) bytes\)", trimmed.stdout)
+            return int(match.group(1)) if match else 0
+        print(f"fstrim on {mount_dir} is not supported, free space is filled with zeros: {trimmed.stderr.strip()}")
+    zero_path = os.path.join(mount_dir, ".zero-fill")
+    # dd stops with an error when the filesystem is full, which is the point
+    _sudo("dd", "if=/dev/zero", f"of={zero_path}", "bs=1M", "status=none", check=False)
+    _sudo("sync")
+    _sudo("rm", "-f", zero_path)
+    return None
+
+
+def trim_filesystems(image_path, mode):
+    """
+    This function used for attaching the image to a loop device and trimming the filesystems of its partitions
+
+    :param image_path: path of raw image
+    :param mode: trim, zero or auto to fill with zeros when trim is not supported
+    :return: dict of bytes trimmed by partition
+    """
+    loop_device = _sudo("losetup", "--find", "--show", "--partscan", image_path).stdout.strip()
+    trimmed = dict()
+    try:
+        _sudo("udevadm", "settle", check=False)
+        partitions = sorted(name for name in os.listdir("/dev")
+                            if re.fullmatch(re.escape(os.path.basename(loop_device)) + r"p\d+", name))
+        for partition in partitions:
+            device = os.path.join("/dev", partition)
+            fs_type = _sudo("blkid", "-o", "value", "-s", "TYPE", device, check=False).stdout.strip()
+            if fs_type not in FILESYSTEMS:
+                print(f"Partition {partition} ({fs_type or 'no filesystem'}) is skipped")
+                continue
+            with tempfile.TemporaryDirectory(prefix="shrink-") as mount_dir:
+                _sudo("mount", device, mount_dir)
+                try:
+                    trimmed[partition] = _trim(mount_dir, mode)
+                finally:
+                    _sudo("umount", mount_dir)
+            if trimmed[partition] is None:
+                print(f"Free space of {partition} ({fs_type}) is filled with zeros")
+            else:
+                print(f"{trimmed[partition]} bytes of {partition} ({fs_type}) are trimmed")
+    finally:
+        _sudo("losetup", "--detach", loop_device)
+    return trimmed
+
+
+def truncate_image(image_path):
+    """
+    This function used for truncating the image after its last partition, the backup GPT is moved to the new end
+
+    :return: new size of the image
+    """
+    end, gpt = partitions_end(image_path)
+    if gpt:
+        end += GPT_BACKUP_SECTORS * SECTOR_SIZE
+    new_size = -(-end // MB) * MB
+    if new_size >= os.path.getsize(image_path):
+        return os.path.getsize(image_path)
+    os.truncate(image_path, new_size)
+    if gpt:
+        subprocess.run(["sgdisk", "-e", image_path], check=True, capture_output=True)
+    return new_size
+
+
+def shrink_image(image_path, mode="auto", truncate=False):
+    """
+    :param image_path: path of raw image
+    :param mode: trim, zero, auto or none to only punch holes in the zero regions of the image
+    :param truncate: truncate the image after its last partition
+    :return: dict with the sizes of the image before and after
+    """
+    report = {"image": image_path, "size_before": os.path.getsize(image_path),
+              "allocated_before": allocated_size(image_path), "trimmed": dict()}
+    if mode != "none":
+        report["trimmed"] = trim_filesystems(image_path, mode)
+    # Blocks of zeros, written by the build or by the zero fill, become holes
+    subprocess.run(["fallocate", "--dig-holes", image_path], check=True)
+    if truncate:
+        truncate_image(image_path)
+    report["size_after"] = os.path.getsize(image_path)
+    report["allocated_after"] = allocated_size(image_path)
+    report["bytes_saved"] = report["allocated_before"] - report["allocated_after"]
+    return report
+
+
+if __name__ == "__main__":
+    OS_IMAGE_NAME = os.getenv("OS_IMAGE_NAME")
+    OUTPUT_DIR = os.getenv("output_dir", "/var/os-images")
+    IMAGE_TYPE = os.getenv("image_type", "raw")
+    # trim, zero, auto to fill with zeros when trim is not supported, or none
+    SHRINK_MODE = os.getenv("shrink_mode", "auto")
+    SHRINK_TRUNCATE = os.getenv("shrink_truncate", "false").lower() == "true"
+    REPORT_PATH = os.getenv("shrink_report_path", "shrink_report.json")
+
+    if IMAGE_TYPE != "raw":
+        print(f"Only raw images are shrunk, {IMAGE_TYPE} image is left as it is")
+        sys.exit(0)
+    if SHRINK_MODE not in ("trim", "zero", "auto", "none"):
+        print("shrink_mode should be one of trim, zero, auto, none")
+        sys.exit(1)
+    shrink_report = shrink_image(os.path.join(OUTPUT_DIR, f"{OS_IMAGE_NAME}.raw"), SHRINK_MODE, SHRINK_TRUNCATE)
+    print(f"Image {OS_IMAGE_NAME}: {shrink_report['allocated_before'] / MB:.0f} MB allocated before, "
+          f"{shrink_report['allocated_after'] / MB:.0f} MB after, {shrink_report['bytes_saved'] / MB:.0f} MB saved, "
+          f"size {shrink_report['size_before'] / MB:.0f} MB -> {shrink_report['size_after'] / MB:.0f} MB")
+    with open(REPORT_PATH, 'w') as report_file:
+        json.dump(shrink_report, report_file, indent=2)
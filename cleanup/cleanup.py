@@ -1,4 +1,14 @@
+import os
 from resources import Resources
+from sweeper import Sweeper, get_server_names
 
-resources = Resources()
-resources.delete_resources()
+# staged to delete the resources of stage.env, sweep to delete leaked staging resources
+CLEANUP_MODE = os.getenv("cleanup_mode", "staged")
+
+if CLEANUP_MODE == "sweep":
+    sweeper = Sweeper(get_server_names("staging/properties.ini"), int(os.getenv("sweep_max_age_hours", "24")),
+                      int(os.getenv("sweep_workers", "8")), os.getenv("sweep_dry_run", "false").lower() == "true")
+    sweeper.sweep()
+else:
+    resources = Resources()
+    resources.delete_resources()
@@ -1,54 +1,82 @@
 import os
-import openstack
+from openstack_connection import create_openstack_connection, get_auth_config
+from task_graph import TaskGraph
 
-
-def _create_openstack_connection(auth_url, region_name, project_name, username, password, user_domain_name,
-                                 project_domain_name, interface, endpoint_type):
-    return openstack.connect(
-        auth_url=auth_url,
-        project_name=project_name,
-        username=username,
-        password=password,
-        region_name=region_name,
-        user_domain_name=user_domain_name,
-        project_domain_name=project_domain_name,
-        interface=interface,
-        endpoint_type=endpoint_type
-    )
+# Tag of staging images kept in Glance to be reused by later pipelines
+CACHE_TAG = "staging-cache"
+RESOURCE_IDS = ("image_id", "server_id", "keypair_id", "network_id", "subnet_id", "extra_volume_id")
 
 
 class Resources:
-    def __init__(self):
-        self.auth_config = {"auth_url": None, "region_name": None, "project_name": None, "username": None,
-                            "password": None, "user_domain_name": "Default", "project_domain_name": "Default",
-                            "interface": "public", "endpoint_type": "publicURL"}
-        self.image_id = os.getenv("IMAGE_ID")
-        self.server_id = os.getenv("SERVER_ID")
-        self.keypair_id = os.getenv("KEYPAIR_ID")
-        self.network_id = os.getenv("NETWORK_ID")
-        self.subnet_id = os.getenv("SUBNET_ID")
-        self.extra_volume_id = os.getenv("EXTRA_VOLUME_ID")
-        self._set_auth_config()
-        self.conn = _create_openstack_connection(**self.auth_config)
-
-    def _set_auth_config(self):
-        for k in self.auth_config.keys():
-            if os.getenv(k) is not None:
-                self.auth_config[k] = os.getenv(k)
+    def __init__(self, **resource_ids):
+        """
+        :param resource_ids: image_id, server_id, keypair_id, network_id, subnet_id and extra_volume_id to
+        delete, the ids are read from stage.env variables when none is given
+        """
+        if not resource_ids:
+            resource_ids = {name: os.getenv(name.upper()) for name in RESOURCE_IDS}
+        self.image_id = resource_ids.get("image_id")
+        self.server_id = resource_ids.get("server_id")
+        self.keypair_id = resource_ids.get("keypair_id")
+        self.network_id = resource_ids.get("network_id")
+        self.subnet_id = resource_ids.get("subnet_id")
+        self.extra_volume_id = resource_ids.get("extra_volume_id")
+        self.auth_config = get_auth_config()
+        self.conn = create_openstack_connection(**self.auth_config)
 
-    def delete_resources(self):
-        print("Delete resources:")
+    def _delete_image(self):
+        image = self.conn.image.find_image(self.image_id)
+        if image is not None and CACHE_TAG in (image.tags or []):
+            print(f"Image {self.image_id} is cached for later pipelines and is kept")
+            return
         self.conn.image.delete_image(self.image_id)
         print(f"Image {self.image_id} is deleted")
+
+    def _delete_server(self):
         server = self.conn.compute.find_server(self.server_id)
+        if server is None:
+            print(f"Server {self.server_id} does not exist")
+            return
         self.conn.compute.delete_server(self.server_id, force=True)
         self.conn.compute.wait_for_delete(server)
         print(f"Server {self.server_id} is deleted")
+
+    def _delete_keypair(self):
         self.conn.compute.delete_keypair(self.keypair_id)
         print(f"Keypair {self.keypair_id} is deleted")
+
+    def _delete_extra_volume(self):
+        volume = self.conn.block_storage.get_volume(self.extra_volume_id)
+        # The volume is detached once the server is deleted
+        self.conn.block_storage.wait_for_status(volume, status='available', failures=['error'], interval=2,
+                                                wait=300)
+        self.conn.block_storage.delete_volume(self.extra_volume_id)
+        print(f"Extra volume {self.extra_volume_id} is deleted")
+
+    def _delete_subnet(self):
         self.conn.network.delete_subnet(self.subnet_id)
         print(f"Subnet {self.subnet_id} is deleted")
+
+    def _delete_network(self):
         self.conn.network.delete_network(self.network_id)
         print(f"Network {self.network_id} is deleted")
-        self.conn.block_storage.delete_volume(self.extra_volume_id)
-        print(f"Extra volume {self.extra_volume_id} is deleted")
+
+    def delete_resources(self):
+        """
+        Delete the resources at the same time in the order of their dependencies, a resource without id is
+        skipped. A failed deletion does not stop the deletions which do not depend on it
+        """
+        print("Delete resources:")
+        steps = [("image", self.image_id, self._delete_image, []),
+                 ("server", self.server_id, self._delete_server, []),
+                 ("keypair", self.keypair_id, self._delete_keypair, []),
+                 ("extra_volume", self.extra_volume_id, self._delete_extra_volume, ["server"]),
+                 ("subnet", self.subnet_id, self._delete_subnet, ["server"]),
+                 ("network", self.network_id, self._delete_network, ["subnet"])]
+        graph = TaskGraph(max_workers=len(steps), keep_going=True)
+        for name, resource_id, delete, depends_on in steps:
+            graph.add(name, delete if resource_id is not None else (lambda: None), depends_on)
+        try:
+            graph.run()
+        finally:
+            graph.print_timings()
@@ -0,0 +1,146 @@
+# This module is used for deleting resources leaked by staging runs which did not clean up
+# Resources are found by the names staging gives them and only the ones older than the age cutoff are deleted
+
+import configparser
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from openstack_connection import create_openstack_connection, get_auth_config
+from resources import CACHE_TAG
+from task_graph import TaskGraph
+
+KEYPAIR_NAME = "gitlab-runner-ssh-key"
+NETWORK_PATTERN = "*_network"
+SUBNET_PATTERN = "*_network_subnet"
+VOLUME_PATTERN = "*_extra_volume"
+# Volumes of the deleted servers are detaching for a while before they can be deleted
+VOLUME_STATUSES = ("available", "detaching")
+
+
+def _created_at(resource):
+    # Services return times with or without Z and microseconds, all of them are UTC
+    value = getattr(resource, "created_at", None)
+    if not value:
+        return None
+    created_at = datetime.fromisoformat(value.rstrip("Z"))
+    return created_at.replace(tzinfo=timezone.utc) if created_at.tzinfo is None else created_at
+
+
+def get_server_names(properties_path):
+    """
+    Staging names servers and images after the images in properties.ini
+    """
+    properties = configparser.ConfigParser()
+    properties.read(properties_path)
+    return properties.sections()
+
+
+class Sweeper:
+    """
+    This class used for finding and deleting leaked staging resources, every kind of resource is deleted in
+    parallel and the kinds are deleted in the order of their dependencies
+    """
+
+    def __init__(self, server_names, max_age_hours=24, workers=8, dry_run=False):
+        """
+        :param server_names: names of servers and images created by staging
+        :param max_age_hours: only resources older than this are deleted
+        :param workers: number of resources deleted at the same time
+        :param dry_run: print the resources without deleting them
+        """
+        self.server_names = server_names
+        self.cutoff = datetime.now(timezone.utc) - timedelta(hours=max_age_hours)
+        self.workers = workers
+        self.dry_run = dry_run
+        self.conn = create_openstack_connection(**get_auth_config())
+        self.summary = dict()
+
+    def _is_old(self, resource):
+        created_at = _created_at(resource)
+        return created_at is not None and created_at < self.cutoff
+
+    def _sweep(self, kind, resources, delete):
+        """
+        Delete the resources of a kind in parallel batches of workers
+
+        :param kind: kind of the resources, used in the log and summary
+        :param resources: resources to delete
+        :param delete: function deleting one resource
+        """
+        resources = [resource for resource in resources if self._is_old(resource)]
+        self.summary[kind] = {"found": len(resources), "deleted": 0, "failed": 0}
+        if self.dry_run:
+            for resource in resources:
+                print(f"{kind} {resource.name} {resource.id} created at {resource.created_at} would be deleted")
+            return
+
+        def delete_one(resource):
+            try:
+                delete(resource)
+                print(f"{kind} {resource.name} {resource.id} is deleted")
+                return True
+            except Exception as error:
+                print(f"Deleting {kind} {resource.name} {resource.id} failed: {error}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(delete_one, resources))
+        self.summary[kind]["deleted"] = results.count(True)
+        self.summary[kind]["failed"] = results.count(False)
+
+    def _delete_server(self, server):
+        self.conn.compute.delete_server(server, force=True)
+        self.conn.compute.wait_for_delete(server)
+
+    def _sweep_servers(self):
+        servers = [server for server in self.conn.compute.servers() if server.name in self.server_names]
+        self._sweep("server", servers, self._delete_server)
+
+    def _sweep_images(self):
+        images = [image for image in self.conn.image.images(visibility='private', tag=['personal'])
+                  if image.name in self.server_names and CACHE_TAG not in (image.tags or [])]
+        self._sweep("image", images, self.conn.image.delete_image)
+
+    def _sweep_keypairs(self):
+        # The list of keypairs has no creation time, it is read from the keypair itself
+        keypairs = [self.conn.compute.get_keypair(keypair.name) for keypair in self.conn.compute.keypairs()
+                    if keypair.name == KEYPAIR_NAME]
+        self._sweep("keypair", keypairs, self.conn.compute.delete_keypair)
+
+    def _delete_volume(self, volume):
+        self.conn.block_storage.wait_for_status(volume, status='available', failures=['error'], interval=2,
+                                                wait=300)
+        self.conn.block_storage.delete_volume(volume)
+
+    def _sweep_volumes(self):
+        volumes = [volume for volume in self.conn.block_storage.volumes()
+                   if fnmatch.fnmatch(volume.name or "", VOLUME_PATTERN) and volume.status in VOLUME_STATUSES]
+        self._sweep("volume", volumes, self._delete_volume)
+
+    def _sweep_subnets(self):
+        # Admin credentials list the subnets of every project, only the ones of this project are swept
+        subnets = [subnet for subnet in self.conn.network.subnets(project_id=self.conn.current_project_id)
+                   if fnmatch.fnmatch(subnet.name, SUBNET_PATTERN)]
+        self._sweep("subnet", subnets, self.conn.network.delete_subnet)
+
+    def _sweep_networks(self):
+        networks = [network for network in self.conn.network.networks(project_id=self.conn.current_project_id)
+                    if fnmatch.fnmatch(network.name, NETWORK_PATTERN)]
+        self._sweep("network", networks, self.conn.network.delete_network)
+
+    def sweep(self):
+        print(f"Sweep resources created before {self.cutoff.isoformat()}:")
+        graph = TaskGraph(keep_going=True)
+        graph.add("servers", self._sweep_servers)
+        graph.add("images", self._sweep_images, depends_on=["servers"])
+        graph.add("keypairs", self._sweep_keypairs, depends_on=["servers"])
+        graph.add("volumes", self._sweep_volumes, depends_on=["servers"])
+        graph.add("subnets", self._sweep_subnets, depends_on=["servers"])
+        graph.add("networks", self._sweep_networks, depends_on=["subnets"])
+        try:
+            graph.run()
+        finally:
+            graph.print_timings()
+            for kind, counts in self.summary.items():
+                print(f"{kind}: {counts['found']} found, {counts['deleted']} deleted, {counts['failed']} failed")
+        return self.summary
@@ -0,0 +1,128 @@
+# This module is used for creating the OpenStack connection of the staging, test and cleanup jobs
+# The Keystone token and the service catalog are kept in a cache file until the token expires, and name to id
+# lookups are kept for a while, so a job neither authenticates again nor repeats lookups of earlier jobs
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import openstack
+
+# Directory of the auth state and lookup cache files
+CACHE_DIR = os.getenv("openstack_cache_dir", os.path.expanduser("~/.cache/cloud-image-builder"))
+# Seconds a name to id lookup is kept
+LOOKUP_TTL = int(os.getenv("openstack_lookup_ttl", "3600"))
+
+_lock = threading.Lock()
+_lookups = None
+
+LOOKUPS = {
+    "flavor": lambda conn, name: conn.compute.find_flavor(name, ignore_missing=False),
+    "network": lambda conn, name: conn.network.find_network(name, ignore_missing=False),
+}
+
+
+def get_auth_config():
+    """
+    This function used for reading the auth config of OpenStack from env
+    """
+    auth_config = {"auth_url": None, "region_name": None, "project_name": None, "username": None,
+                   "password": None, "user_domain_name": "Default", "project_domain_name": "Default",
+                   "interface": "public", "endpoint_type": "publicURL"}
+    for k in auth_config.keys():
+        if os.getenv(k) is not None:
+            auth_config[k] = os.getenv(k)
+    return auth_config
+
+
+def _write_json(path, data):
+    # The file holds a token, it is written atomically and readable by the owner only
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(data, tmp_file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _auth_state_path(*scope):
+    # One file for each user, project and region, the password is not part of the file
+    scope = "|".join(str(value) for value in scope)
+    return os.path.join(CACHE_DIR, f"auth-{hashlib.sha256(scope.encode()).hexdigest()[:16]}.json")
+
+
+def create_openstack_connection(auth_url, region_name, project_name, username, password, user_domain_name,
+                                project_domain_name, interface, endpoint_type):
+    """
+    This function used for creating an OpenStack connection which reuses the cached token and service catalog
+    while the token is valid, a new token is cached after authentication
+    """
+    conn = openstack.connect(
+        auth_url=auth_url,
+        project_name=project_name,
+        username=username,
+        password=password,
+        region_name=region_name,
+        user_domain_name=user_domain_name,
+        project_domain_name=project_domain_name,
+        interface=interface,
+        endpoint_type=endpoint_type
+    )
+    state_path = _auth_state_path(auth_url, region_name, project_name, username, user_domain_name,
+                                  project_domain_name)
+    auth = conn.session.auth
+    auth_state = _read_json(state_path)
+    if auth_state is not None:
+        # An expired token is replaced by keystoneauth on the first request
+        auth.set_auth_state(json.dumps(auth_state))
+    before = auth.get_auth_state()
+    conn.authorize()
+    after = auth.get_auth_state()
+    if after is not None and after != before:
+        _write_json(state_path, json.loads(after))
+    return conn
+
+
+def _lookups_path():
+    return os.path.join(CACHE_DIR, "lookups.json")
+
+
+def find_id(conn, kind, name, ttl=LOOKUP_TTL):
+    """
+    This function used for finding the id of a resource by its name, the id is kept in the cache file for ttl
+    seconds
+
+    :param conn: OpenStack connection
+    :param kind: one of LOOKUPS
+    :param name: name of the resource
+    :param ttl: seconds the id is kept
+    :return: id of the resource
+    """
+    global _lookups
+    key = f"{conn.config.get_region_name()}/{conn.current_project_id}/{kind}/{name}"
+    now = time.time()
+    with _lock:
+        if _lookups is None:
+            _lookups = _read_json(_lookups_path()) or dict()
+        cached = _lookups.get(key)
+    if cached is not None and now - cached["time"] < ttl:
+        return cached["id"]
+    resource_id = LOOKUPS[kind](conn, name).id
+    with _lock:
+        _lookups = {k: v for k, v in (_read_json(_lookups_path()) or _lookups).items() if now - v["time"] < ttl}
+        _lookups[key] = {"id": resource_id, "time": now}
+        _write_json(_lookups_path(), _lookups)
+    return resource_id
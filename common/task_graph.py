@@ -0,0 +1,76 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class TaskGraph:
+    """
+    This class used for running steps on a pool of threads, each step starts as soon as the steps it
+    depends on are done
+    """
+
+    def __init__(self, max_workers=4, keep_going=False):
+        """
+        :param max_workers: number of steps run at the same time
+        :param keep_going: on failure, keep running the steps that do not depend on the failed one
+        """
+        self.max_workers = max_workers
+        self.keep_going = keep_going
+        self.tasks = dict()
+        self.timings = dict()
+        self.skipped = set()
+
+    def add(self, name, func, depends_on=()):
+        for dependency in depends_on:
+            if dependency not in self.tasks:
+                raise ValueError(f"step {name} depends on unknown step {dependency}")
+        self.tasks[name] = (func, tuple(depends_on))
+
+    def _timed(self, name, func, start):
+        step_start = time.monotonic()
+        try:
+            return func()
+        finally:
+            step_end = time.monotonic()
+            self.timings[name] = {"start": step_start - start, "end": step_end - start,
+                                  "seconds": step_end - step_start}
+
+    def run(self):
+        """
+        Run every step, when a step fails the running steps are finished, no new step is started (or, with
+        keep_going, only the steps depending on it are skipped) and the first error is raised
+        """
+        start = time.monotonic()
+        done = set()
+        failed = set()
+        running = dict()
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                if error is None or self.keep_going:
+                    for name, (func, depends_on) in self.tasks.items():
+                        if name in done or name in failed or name in self.skipped or name in running.values():
+                            continue
+                        if set(depends_on) & (failed | self.skipped):
+                            print(f"Step {name} is skipped")
+                            self.skipped.add(name)
+                        elif set(depends_on) <= done:
+                            running[executor.submit(self._timed, name, func, start)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        print(f"Step {name} failed: {future.exception()}")
+                        failed.add(name)
+                        error = error or future.exception()
+                    else:
+                        done.add(name)
+        if error is not None:
+            raise error
+        return self.timings
+
+    def print_timings(self):
+        print("Step timings:")
+        for name, timing in sorted(self.timings.items(), key=lambda item: item[1]["start"]):
+            print(f"{name}: {timing['start']:.1f}s -> {timing['end']:.1f}s ({timing['seconds']:.1f}s)")
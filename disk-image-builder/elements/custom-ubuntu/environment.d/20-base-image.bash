@@ -0,0 +1,12 @@
+# The base image and its SHA256SUMS, root.d/10-cache-ubuntu-tarball downloads them and build/build_image.py keys
+# the root layer by the sha256 of the image in the SHA256SUMS
+export DIB_RELEASE=${DIB_RELEASE:-trusty}
+export DIB_CLOUD_IMAGES=${DIB_CLOUD_IMAGES:-https://cloud-images.ubuntu.com/$DIB_RELEASE/current}
+if [ $DIB_RELEASE != "trusty" ] ; then
+    export BASE_IMAGE_FILE=${BASE_IMAGE_FILE:-$DIB_RELEASE-server-cloudimg-$ARCH.squashfs}
+else
+    export BASE_IMAGE_FILE=${BASE_IMAGE_FILE:-$DIB_RELEASE-server-cloudimg-$ARCH-root.tar.gz}
+fi
+_cloud_images_path=${DIB_CLOUD_IMAGES#http://}
+export SHA256SUMS=${SHA256SUMS:-https://${_cloud_images_path#https://}/SHA256SUMS}
+unset _cloud_images_path
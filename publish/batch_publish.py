@@ -0,0 +1,90 @@
+# This script is used for uploading several images to distribution dir on object storage at the same time
+
+import configparser
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from compressed_stream import OUTPUT_FORMATS
+from transfer_budget import TransferBudget
+from upload_image_to_s3 import MB, create_s3_client, publish_image
+
+
+def get_image_names(images: str, properties_path: str):
+    """
+    Get the names of images to publish
+
+    :param images: comma separated image names, or all for every section of properties.ini
+    :param properties_path: path of properties.ini
+    """
+    if images.strip() == "all":
+        properties = configparser.ConfigParser()
+        properties.read(properties_path)
+        return properties.sections()
+    return [image.strip() for image in images.split(",") if image.strip()]
+
+
+def publish_images(image_names, image_dir: str, bucket: str, dir_name: str, output_format: str, dedup: bool,
+                   parallel_images: int, max_parts: int, bytes_per_second: int, compress_workers: int,
+                   delta: bool = False):
+    """
+    Publish images at the same time through one S3 client and one transfer budget
+
+    :return: list of result of each image
+    """
+    s3_client = create_s3_client(max_parts + parallel_images)
+    budget = TransferBudget(max_parts, bytes_per_second)
+    # Workers and compression processes are split between the images uploaded at the same time
+    workers = -(-max_parts // parallel_images)
+    compress_workers = max(1, compress_workers // parallel_images)
+
+    def publish(image_name):
+        image_path = os.path.join(image_dir, image_name + ".raw")
+        if not os.path.exists(image_path):
+            print(f"image file {image_path} does not exists")
+            return {"image": image_path, "key": dir_name + '/' + image_name, "status": "missing", "checksum": None,
+                    "size": 0, "seconds": 0.0}
+        return publish_image(s3_client, image_path, bucket, dir_name + '/' + image_name, output_format, dedup,
+                             workers, compress_workers, budget=budget, delta=delta)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=parallel_images) as executor:
+        futures = [(image_name, executor.submit(publish, image_name)) for image_name in image_names]
+        for image_name, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as error:
+                # One image which fails does not stop the others, it is reported in the summary
+                print(f"Publish of {image_name} failed: {error}")
+                results.append({"image": os.path.join(image_dir, image_name + ".raw"),
+                                "key": dir_name + '/' + image_name, "status": "failed", "checksum": None,
+                                "size": 0, "seconds": 0.0, "error": str(error)})
+    return results
+
+
+def print_summary(results):
+    print("Publish summary:")
+    for result in results:
+        throughput = result["size"] / MB / result["seconds"] if result["seconds"] else 0.0
+        copied = f", {result['copied_bytes'] / MB:.0f} MB copied" if result.get("copied_bytes") else ""
+        print(f"{result['key']}: {result['status']} {result['size'] / MB:.0f} MB in {result['seconds']:.1f} s "
+              f"({throughput:.1f} MB/s){copied}")
+
+
+if __name__ == "__main__":
+    OUTPUT_FORMAT = os.getenv("output_format", "raw")
+    if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+        print(f"output_format should be one of {', '.join(OUTPUT_FORMATS)}")
+        sys.exit(1)
+    IMAGE_NAMES = get_image_names(os.getenv("images", "all"), "staging/properties.ini")
+    RESULTS = publish_images(IMAGE_NAMES, os.getenv("image_dir", "/var/os-images"), os.getenv("bucketname"),
+                             os.getenv("dir"), OUTPUT_FORMAT, os.getenv("dedup", "false").lower() == "true",
+                             int(os.getenv("parallel_images", "4")), int(os.getenv("max_parts", "16")),
+                             int(os.getenv("max_bandwidth_mb", "0")) * MB,
+                             int(os.getenv("compress_workers", str(os.cpu_count()))),
+                             os.getenv("delta", "false").lower() == "true")
+    print_summary(RESULTS)
+    with open(os.getenv("summary_path", "publish_summary.json"), 'w') as summary_file:
+        json.dump(RESULTS, summary_file, indent=2)
+    if any(result["status"] not in ("uploaded", "unchanged") for result in RESULTS):
+        sys.exit(1)
@@ -0,0 +1,79 @@
+# This module is used for keeping the list of chunks of a published image next to its object on S3
+# The chunks are the parts of the multipart upload, a new version copies the parts it shares with the previous one
+# on the object storage instead of uploading them
+
+import json
+import logging
+from botocore.exceptions import BotoCoreError, ClientError
+
+MANIFEST_SUFFIX = ".chunks.json"
+
+
+class ChunkManifest:
+    """
+    This class used for describing an object as a list of fixed size chunks with their sha256 and md5
+    """
+
+    def __init__(self, part_size: int, chunks: list, checksum: str = None, etag: str = None):
+        """
+        :param part_size: size of every chunk but the last one
+        :param chunks: dict of sha256, md5 and size of each chunk in order
+        :param checksum: md5 checksum of the object
+        :param etag: etag of the object
+        """
+        self.part_size = part_size
+        self.chunks = chunks
+        self.checksum = checksum
+        self.etag = etag
+        # Version of the object the manifest describes, when the bucket is versioned
+        self.version_id = None
+
+    @property
+    def size(self):
+        return sum(chunk["size"] for chunk in self.chunks)
+
+    def locations(self):
+        """
+        :return: dict of sha256 of chunk to its (offset, size) in the object
+        """
+        locations = dict()
+        offset = 0
+        for chunk in self.chunks:
+            locations.setdefault(chunk["sha256"], (offset, chunk["size"]))
+            offset += chunk["size"]
+        return locations
+
+    def to_dict(self):
+        return {"part_size": self.part_size, "size": self.size, "checksum": self.checksum, "etag": self.etag,
+                "chunks": self.chunks}
+
+    def save(self, s3_client, bucket, key):
+        s3_client.put_object(Bucket=bucket, Key=key + MANIFEST_SUFFIX, Body=json.dumps(self.to_dict()).encode(),
+                             ContentType="application/json")
+
+    @classmethod
+    def load(cls, s3_client, bucket, key):
+        """
+        Load the manifest of an object, it is only used when it describes the object which is on the object
+        storage now
+
+        :return: ChunkManifest or None
+        """
+        try:
+            head = s3_client.head_object(Bucket=bucket, Key=key)
+            response = s3_client.get_object(Bucket=bucket, Key=key + MANIFEST_SUFFIX)
+            manifest = json.loads(response['Body'].read())
+        except ClientError as error:
+            if error.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+                logging.error(error)
+            return None
+        except (BotoCoreError, ValueError) as error:
+            logging.error(error)
+            return None
+        chunk_manifest = cls(manifest["part_size"], manifest["chunks"], manifest.get("checksum"),
+                             manifest.get("etag"))
+        if chunk_manifest.etag != head['ETag'] or chunk_manifest.size != head['ContentLength']:
+            print(f"Chunk manifest of {key} does not describe the object on the object storage")
+            return None
+        chunk_manifest.version_id = head.get('VersionId')
+        return chunk_manifest
@@ -0,0 +1,168 @@
+# This module is used for producing the published bytes of an image in raw, zstd or qcow2 format
+
+import functools
+import hashlib
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from image_hash import calculate_checksum
+from sparse_file import SparseReader, update_with_zeros
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+OUTPUT_FORMATS = ("raw", "zst", "qcow2")
+ZSTD_LEVEL = 3
+# Every frame of the zstd stream holds this many bytes of the image, a reader can seek to any frame
+ZSTD_FRAME_SIZE = 16 * 1024 * 1024
+SKIPPABLE_FRAME_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+
+
+def _compress_frame(data, level):
+    return zstandard.ZstdCompressor(level=level, write_checksum=True).compress(data)
+
+
+@functools.lru_cache(maxsize=None)
+def _zero_frame(size, level):
+    return _compress_frame(bytes(size), level)
+
+
+def seek_table(frames):
+    """
+    This function used for building the seek table of the zstd seekable format
+
+    :param frames: list of (compressed size, decompressed size) of each frame
+    :return seek table as a skippable frame
+    """
+    entries = b"".join(struct.pack("<II", compressed, decompressed) for compressed, decompressed in frames)
+    footer = struct.pack("<IBI", len(frames), 0, SEEKABLE_MAGIC)
+    return struct.pack("<II", SKIPPABLE_FRAME_MAGIC, len(entries) + len(footer)) + entries + footer
+
+
+class ZstdSource(SparseReader):
+    """
+    This class used for publishing the image as a seekable multi-frame zstd stream. Frames are compressed
+    on a pool of processes while the image is read, the compressed image is never written to disk
+    """
+
+    def __init__(self, file_path: str, workers: int = None):
+        if zstandard is None:
+            raise RuntimeError("zstandard package is required for zst output format")
+        super().__init__(file_path)
+        self._workers = workers or os.cpu_count()
+        self._md5_hash = hashlib.md5()
+
+    @property
+    def raw_checksum(self):
+        return self._md5_hash.hexdigest()
+
+    def _frames(self):
+        """
+        Yield compressed frames in order with their decompressed size
+        """
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self._workers) as executor:
+            for _, length, data in super().parts(ZSTD_FRAME_SIZE):
+                if data is None:
+                    update_with_zeros(self._md5_hash, length)
+                    pending.append((length, None, _zero_frame(length, ZSTD_LEVEL)))
+                else:
+                    self._md5_hash.update(data)
+                    pending.append((length, executor.submit(_compress_frame, data, ZSTD_LEVEL), None))
+                # Keeps every worker busy without holding the whole image in memory
+                while len(pending) > self._workers * 2:
+                    yield self._pop_frame(pending)
+            while pending:
+                yield self._pop_frame(pending)
+
+    @staticmethod
+    def _pop_frame(pending):
+        length, future, frame = pending.popleft()
+        return length, frame if future is None else future.result()
+
+    def parts(self, chunk_size):
+        buffer = bytearray()
+        offset = 0
+        frames = []
+        for length, frame in self._frames():
+            frames.append((len(frame), length))
+            buffer += frame
+            while len(buffer) >= chunk_size:
+                yield offset, chunk_size, bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
+                offset += chunk_size
+        buffer += seek_table(frames)
+        while buffer:
+            length = min(chunk_size, len(buffer))
+            yield offset, length, bytes(buffer[:length])
+            del buffer[:length]
+            offset += length
+
+
+class Qcow2Source(SparseReader):
+    """
+    This class used for publishing the image as qcow2 with compressed clusters. The qcow2 header points to
+    tables that are only known once all clusters are written, so qemu-img converts the image to a temporary
+    qcow2 file next to it and the checksum of the image is calculated while it converts
+    """
+
+    def __init__(self, file_path: str, workers: int = None):
+        self._raw_checksum = None
+        self._checksum_error = None
+        self._tmp_dir = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(file_path)))
+        qcow2_path = os.path.join(self._tmp_dir.name, os.path.basename(file_path) + ".qcow2")
+        checksum_thread = threading.Thread(target=self._calculate_raw_checksum, args=(file_path,))
+        checksum_thread.start()
+        try:
+            # Writes stay in order so the same image always converts to the same bytes and an upload can resume
+            subprocess.run(["qemu-img", "convert", "-c", "-m", str(workers or os.cpu_count()),
+                            "-f", "raw", "-O", "qcow2", file_path, qcow2_path], check=True)
+        except (OSError, subprocess.CalledProcessError) as error:
+            self._tmp_dir.cleanup()
+            raise OSError(f"qemu-img convert failed: {error}") from error
+        finally:
+            checksum_thread.join()
+        if self._checksum_error is not None:
+            self._tmp_dir.cleanup()
+            raise OSError(f"checksum of {file_path} failed: {self._checksum_error}") from self._checksum_error
+        super().__init__(qcow2_path)
+
+    def _calculate_raw_checksum(self, file_path):
+        # An error of the thread is raised by the constructor, the upload fails instead of tagging no checksum
+        try:
+            self._raw_checksum = calculate_checksum(file_path, ZSTD_FRAME_SIZE)
+        except Exception as error:
+            self._checksum_error = error
+
+    @property
+    def raw_checksum(self):
+        return self._raw_checksum
+
+    def close(self):
+        super().close()
+        self._tmp_dir.cleanup()
+
+
+def open_source(file_path: str, output_format: str, workers: int = None):
+    """
+    This function used for opening the published bytes of an image
+
+    :param file_path: path of raw image
+    :param output_format: one of OUTPUT_FORMATS
+    :param workers: number of compression processes, all cores by default
+    :return reader with parts(chunk_size), compressed readers also have raw_checksum of the image
+    """
+    if output_format == "raw":
+        return SparseReader(file_path)
+    if output_format == "zst":
+        return ZstdSource(file_path, workers)
+    if output_format == "qcow2":
+        return Qcow2Source(file_path, workers)
+    raise ValueError(f"output format should be one of {', '.join(OUTPUT_FORMATS)}")
@@ -0,0 +1,242 @@
+# This script is used for downloading published images from distribution dir on object storage
+# The object is fetched with concurrent ranged requests aligned to the parts it was uploaded with, written into a
+# sparse file and verified while it is downloaded
+#
+#   bucketname=BUCKET dir=DIR object_name=Ubuntu-22.04 download_path=/var/os-images/Ubuntu-22.04.raw \
+#   python3 publish/download_image.py
+
+import hashlib
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError
+from chunk_manifest import ChunkManifest
+from image_hash import multipart_etag
+from sparse_file import ZERO_BUFFER_SIZE, update_with_zeros, zero_bytes
+from streaming_upload import choose_part_size
+from transfer_metrics import TransferMetrics
+from upload_image_to_s3 import MULTIPART_CHUNKSIZE, RETRY, create_s3_client
+
+# Size of each read of a part, a block of zeros is not written so it stays a hole of the file
+BLOCK_SIZE = ZERO_BUFFER_SIZE
+
+
+class VerificationError(Exception):
+    pass
+
+
+def find_part_size(s3_client, bucket: str, key: str, size: int, etag: str, manifest: ChunkManifest = None):
+    """
+    This function used for finding the part size the object was uploaded with
+
+    :return: part size in bytes
+    """
+    if manifest is not None:
+        return manifest.part_size
+    if "-" not in etag:
+        # Uploaded in one request, any part size gives the same checksum
+        return choose_part_size(size, MULTIPART_CHUNKSIZE)
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key, PartNumber=1)['ContentLength']
+    except ClientError as error:
+        logging.error(error)
+    # The part size publish chooses for an object of this size
+    return choose_part_size(size, MULTIPART_CHUNKSIZE)
+
+
+class RangedDownload:
+    """
+    This class used for downloading an object with a pool of workers, each worker fetches a part with a ranged
+    request and writes it into a preallocated file, blocks of zeros are not written. The md5 of every part is
+    calculated as it arrives and checked against the chunk manifest of the object when there is one, the etag is
+    checked once the last part is in. The checksum of the whole file is calculated in part order from the data of
+    the parts while the later parts are still downloaded, a part waits in memory until the parts before it are
+    hashed, so only a window of parts is downloaded ahead
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, file_path: str, workers: int = 8, metrics=None):
+        self._s3_client = s3_client
+        self._bucket = bucket
+        self._key = key
+        self._file_path = file_path
+        self._workers = workers
+        # TransferMetrics of the download
+        self._metrics = metrics
+        self.size = None
+        self.etag = None
+        self.checksum = None
+        self.part_size = None
+        self._manifest = None
+        self._fd = None
+
+    def download(self):
+        """
+        Download and verify the object, the file is only put in place when the object is verified
+
+        :return: True if the object was downloaded and verified, else False
+        """
+        try:
+            head = self._s3_client.head_object(Bucket=self._bucket, Key=self._key)
+            tag_set = self._s3_client.get_object_tagging(Bucket=self._bucket, Key=self._key)['TagSet']
+            self.size = head['ContentLength']
+            self.etag = head['ETag']
+            self._manifest = ChunkManifest.load(self._s3_client, self._bucket, self._key)
+            self.part_size = find_part_size(self._s3_client, self._bucket, self._key, self.size, self.etag,
+                                            self._manifest)
+        except (ClientError, BotoCoreError) as error:
+            logging.error(error)
+            return False
+        tags = {tag['Key']: tag['Value'] for tag in tag_set}
+        part_count = -(-self.size // self.part_size)
+        if "-" in self.etag and not self.etag.endswith(f'-{part_count}"'):
+            print(f"Etag {self.etag} of {self._key} does not match {part_count} parts of {self.part_size} bytes")
+            return False
+
+        partial_path = self._file_path + ".part"
+        with open(partial_path, 'w+b') as partial_file:
+            # The file is allocated without writing it, parts of zeros stay holes
+            partial_file.truncate(self.size)
+            self._fd = partial_file.fileno()
+            try:
+                part_digests = self._download_parts(part_count)
+            except (ClientError, BotoCoreError, OSError, VerificationError) as error:
+                logging.error(error)
+                os.unlink(partial_path)
+                return False
+            os.fsync(self._fd)
+
+        if "-" in self.etag:
+            calculated_etag = multipart_etag(part_digests)
+        else:
+            calculated_etag = f'"{self.checksum}"'
+        mismatch = None
+        if calculated_etag != self.etag:
+            mismatch = f"etag is {calculated_etag}, expected {self.etag}"
+        elif 'checksum' in tags and tags['checksum'] != self.checksum:
+            mismatch = f"checksum is {self.checksum}, expected {tags['checksum']}"
+        if mismatch is not None:
+            print(f"Verification of {self._key} is not successful, {mismatch}")
+            os.unlink(partial_path)
+            return False
+        if 'checksum' not in tags:
+            print(f"{self._key} has no checksum tag, only its etag is verified")
+        os.replace(partial_path, self._file_path)
+        return True
+
+    def _download_parts(self, part_count):
+        """
+        Download the parts and calculate the checksum of the file in part order
+
+        :return: md5 digest of each part
+        """
+        md5_hash = hashlib.md5()
+        # Parts downloaded ahead of the part which is hashed, their data is kept in memory until then
+        window = self._workers * 2
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = dict()
+            next_part = 1
+            try:
+                part_digests = []
+                for part_number in range(1, part_count + 1):
+                    while next_part <= part_count and len(futures) < window:
+                        futures[next_part] = executor.submit(self._download_part, next_part)
+                        next_part += 1
+                    part_digest, blocks = futures.pop(part_number).result()
+                    part_digests.append(part_digest)
+                    for block in blocks:
+                        # A block of zeros is kept as its size
+                        if isinstance(block, int):
+                            update_with_zeros(md5_hash, block)
+                        else:
+                            md5_hash.update(block)
+            except BaseException:
+                for future in futures.values():
+                    future.cancel()
+                raise
+        self.checksum = md5_hash.hexdigest()
+        return part_digests
+
+    def _download_part(self, part_number):
+        """
+        Download a part, a part which fails or does not match its md5 in the chunk manifest is downloaded again
+
+        :return: md5 digest of the part and its blocks
+        """
+        offset = (part_number - 1) * self.part_size
+        length = min(self.part_size, self.size - offset)
+        expected = self._manifest.chunks[part_number - 1]["md5"] if self._manifest is not None else None
+        for attempt in range(1, RETRY + 1):
+            try:
+                # A part which is downloaded again may have written data where the object has zeros
+                part_digest, blocks = self._fetch_range(offset, length, write_zeros=attempt > 1)
+            except (ClientError, BotoCoreError, OSError) as error:
+                # The object changed on the object storage, downloading it again does not help
+                if isinstance(error, ClientError) and \
+                        error.response.get('Error', {}).get('Code') in ('PreconditionFailed', '412'):
+                    raise
+                if attempt == RETRY:
+                    raise
+                print(f"Download of part {part_number} is not successful try again... {error}")
+                continue
+            if expected is None or part_digest.hex() == expected:
+                return part_digest, blocks
+            print(f"Part {part_number} md5 is {part_digest.hex()}, expected {expected}")
+        raise VerificationError(f"part {part_number} of {self._key} does not match its chunk manifest")
+
+    def _fetch_range(self, offset, length, write_zeros=False):
+        """
+        :return: md5 digest of the range and its blocks, a block of zeros is given as its size
+        """
+        start = time.monotonic()
+        response = self._s3_client.get_object(Bucket=self._bucket, Key=self._key, IfMatch=self.etag,
+                                              Range=f"bytes={offset}-{offset + length - 1}")
+        md5_hash = hashlib.md5()
+        blocks = []
+        position = offset
+        body = response['Body']
+        while position < offset + length:
+            data = body.read(min(BLOCK_SIZE, offset + length - position))
+            if not data:
+                raise OSError(f"Range {offset}-{offset + length - 1} of {self._key} ends at {position}")
+            md5_hash.update(data)
+            zeros = data == zero_bytes(len(data))
+            if write_zeros or not zeros:
+                os.pwrite(self._fd, data, position)
+            blocks.append(len(data) if zeros else data)
+            position += len(data)
+            self._report(len(data))
+        if self._metrics is not None:
+            self._metrics.observe_part(time.monotonic() - start)
+        return md5_hash.digest(), blocks
+
+    def _report(self, bytes_amount):
+        if self._metrics is not None:
+            self._metrics(bytes_amount)
+
+
+if __name__ == "__main__":
+    DOWNLOAD_WORKERS = int(os.getenv("download_workers", "8"))
+    # Seconds between progress lines
+    PROGRESS_INTERVAL = float(os.getenv("progress_interval", "10"))
+    BUCKETNAME = os.getenv("bucketname")
+    DOWNLOAD_PATH = os.getenv("download_path")
+
+    key_name = os.getenv("dir") + '/' + os.getenv("object_name")
+    s3_client = create_s3_client(DOWNLOAD_WORKERS)
+    try:
+        head = s3_client.head_object(Bucket=BUCKETNAME, Key=key_name)
+    except (ClientError, BotoCoreError) as error:
+        logging.error(error)
+        print("Download is not successful")
+        sys.exit(1)
+    with TransferMetrics(os.getenv("object_name"), head['ContentLength'], PROGRESS_INTERVAL) as metrics:
+        download = RangedDownload(s3_client, BUCKETNAME, key_name, DOWNLOAD_PATH, DOWNLOAD_WORKERS, metrics)
+        with metrics.phase("download"):
+            success = download.download()
+    if not success:
+        print("Download is not successful")
+        sys.exit(1)
+    print(f"{key_name} is downloaded to {DOWNLOAD_PATH} in parts of {download.part_size} bytes")
+    print("Checksum of image: " + download.checksum)
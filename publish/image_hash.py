@@ -0,0 +1,151 @@
+# This module is used for calculating checksum and etag of images
+# It can be run to check an image on disk:
+#   python3 publish/image_hash.py IMAGE [--part-size MB] [--workers N] [--etag ETAG] [--checksum MD5]
+
+import argparse
+import hashlib
+import mmap
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from sparse_file import SparseReader, update_with_zeros, zero_md5
+
+# Size of each slice fed to the checksum of the whole file
+CHECKSUM_SLICE_SIZE = 8 * 1024 * 1024
+
+
+def multipart_etag(part_digests):
+    """
+    This function used for building the etag of a multipart upload from the md5 of its parts
+
+    :param part_digests: md5 digest (bytes) of each part in part order
+    :return etag value of the object
+    """
+    if not part_digests:  # empty file
+        return f'"{hashlib.md5().hexdigest()}"'
+    new_md5 = hashlib.md5(b"".join(part_digests))
+    return f'"{new_md5.hexdigest()}-{len(part_digests)}"'
+
+
+def _md5_digest(data):
+    # hashlib releases the GIL while it hashes large buffers, so parts are hashed on all cores
+    with data:
+        return hashlib.md5(data).digest()
+
+
+def _update_checksum(md5_hash, view, reader, offset, length):
+    # Feeds a part to the checksum of the whole file, holes inside the part are not read
+    end = offset + length
+    for slice_offset in range(offset, end, CHECKSUM_SLICE_SIZE):
+        slice_length = min(CHECKSUM_SLICE_SIZE, end - slice_offset)
+        if reader.is_hole(slice_offset, slice_length):
+            update_with_zeros(md5_hash, slice_length)
+        else:
+            with view[slice_offset:slice_offset + slice_length] as data:
+                md5_hash.update(data)
+
+
+def hash_image(source_path, chunk_size, workers=None, checksum=True, etag=True):
+    """
+    This function used for calculating etag and md5 checksum of file in one read. The file is memory
+    mapped, its parts are hashed in parallel on a pool of threads and each part is fed to the checksum
+    in part order while its workers hash it, so a part is read from disk once. Parts that are holes of a
+    sparse file are not read
+
+    :param source_path: file path to calculate md5
+    :param chunk_size: size for each part of file
+    :param workers: number of threads hashing parts, all cores by default
+    :param checksum: calculate md5 checksum of the whole file too
+    :param etag: calculate etag of the file too
+    :return md5 checksum (None when checksum is False) and etag value of file (None when etag is False)
+    """
+    with SparseReader(source_path) as reader:
+        if reader.size == 0:
+            return hashlib.md5().hexdigest() if checksum else None, multipart_etag([]) if etag else None
+        with mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view, ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+                md5_hash = hashlib.md5() if checksum else None
+                part_digests = []
+                for offset in range(0, reader.size, chunk_size):
+                    length = min(chunk_size, reader.size - offset)
+                    if reader.is_hole(offset, length):
+                        if etag:
+                            part_digests.append(zero_md5(length))
+                        if md5_hash is not None:
+                            update_with_zeros(md5_hash, length)
+                        continue
+                    if etag:
+                        part_digests.append(executor.submit(_md5_digest, view[offset:offset + length]))
+                    if md5_hash is not None:
+                        _update_checksum(md5_hash, view, reader, offset, length)
+                part_digests = [digest if isinstance(digest, bytes) else digest.result() for digest in part_digests]
+                file_checksum = md5_hash.hexdigest() if checksum else None
+    return file_checksum, multipart_etag(part_digests) if etag else None
+
+
+def calculate_multipart_etag(source_path, chunk_size, workers=None):
+    """
+    This function used for calculating etag of file
+
+    :param source_path: file path to calculate md5
+    :param chunk_size: size for each part of file
+    :param workers: number of threads hashing parts
+    :return etag value file
+    """
+    return hash_image(source_path, chunk_size, workers, checksum=False)[1]
+
+
+def calculate_checksum(source_path, chunk_size):
+    """
+    This function used for calculating md5 checksum of file, holes are hashed without reading them
+
+    :param source_path: file path to calculate md5
+    :param chunk_size: size of each read
+    :return md5 checksum of file
+    """
+    return hash_image(source_path, chunk_size, etag=False)[0]
+
+
+def calculate_checksum_and_etag(source_path, chunk_size, workers=None):
+    """
+    This function used for calculating md5 checksum and etag of file in one read
+
+    :param source_path: file path to calculate md5
+    :param chunk_size: size for each part of file
+    :param workers: number of threads hashing parts
+    :return md5 checksum and etag value of file
+    """
+    return hash_image(source_path, chunk_size, workers)
+
+
+if __name__ == "__main__":
+    from streaming_upload import MB, choose_part_size
+
+    parser = argparse.ArgumentParser(description="Calculate md5 checksum and S3 etag of an image")
+    parser.add_argument("image_path")
+    parser.add_argument("--part-size", type=int, default=None,
+                        help="part size in MB, by default the part size publish chooses for the image")
+    parser.add_argument("--min-part-size", type=int, default=15, help="smallest part size of publish in MB")
+    parser.add_argument("--workers", type=int, default=None, help="threads hashing parts")
+    parser.add_argument("--etag", default=None, help="expected etag")
+    parser.add_argument("--checksum", default=None, help="expected md5 checksum")
+    args = parser.parse_args()
+
+    if args.part_size is not None:
+        part_size = args.part_size * MB
+    else:
+        part_size = choose_part_size(os.path.getsize(args.image_path), args.min_part_size * MB)
+    image_checksum, image_etag = hash_image(args.image_path, part_size, args.workers)
+    print(f"Part size: {part_size // MB} MB")
+    print(f"Checksum: {image_checksum}")
+    print(f"Etag: {image_etag}")
+    match = True
+    if args.etag is not None and args.etag.strip('"') != image_etag.strip('"'):
+        print("Etag does not match")
+        match = False
+    if args.checksum is not None and args.checksum != image_checksum:
+        print("Checksum does not match")
+        match = False
+    sys.exit(0 if match else 1)
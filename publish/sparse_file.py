@@ -0,0 +1,157 @@
+# This module is used for reading sparse raw images without reading or hashing their holes
+
+import bisect
+import errno
+import functools
+import hashlib
+import os
+
+ZERO_BUFFER_SIZE = 1024 * 1024
+ZERO_BUFFER = memoryview(bytes(ZERO_BUFFER_SIZE))
+
+
+def data_extents(fd, size):
+    """
+    This function used for mapping data regions of a file with SEEK_DATA/SEEK_HOLE
+
+    :param fd: file descriptor of the file
+    :param size: size of the file
+    :return list of (start, end) offsets of data regions
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)] if size else []
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:  # no data after offset
+                break
+            if error.errno == errno.EINVAL:  # file system does not support it
+                return [(0, size)]
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        extents.append((start, end))
+        offset = end
+    return extents
+
+
+@functools.lru_cache(maxsize=None)
+def zero_bytes(size):
+    """
+    This function used for getting a shared zero buffer of the given size
+    """
+    return bytes(size)
+
+
+@functools.lru_cache(maxsize=None)
+def zero_md5(size):
+    """
+    This function used for getting the md5 digest of a zero chunk of the given size
+    """
+    md5_hash = hashlib.md5()
+    update_with_zeros(md5_hash, size)
+    return md5_hash.digest()
+
+
+@functools.lru_cache(maxsize=None)
+def zero_sha256(size):
+    """
+    This function used for getting the sha256 of a zero chunk of the given size
+    """
+    sha256_hash = hashlib.sha256()
+    update_with_zeros(sha256_hash, size)
+    return sha256_hash.hexdigest()
+
+
+def update_with_zeros(md5_hash, size):
+    """
+    This function used for feeding zeros to a hash from the preallocated zero buffer
+    """
+    while size > 0:
+        length = min(size, ZERO_BUFFER_SIZE)
+        md5_hash.update(ZERO_BUFFER[:length])
+        size -= length
+
+
+class SparseReader:
+    """
+    This class used for reading parts of a file where only data regions are read from disk
+    """
+
+    def __init__(self, file_path: str):
+        self._file = open(file_path, 'rb')
+        self._fd = self._file.fileno()
+        self.size = os.fstat(self._fd).st_size
+        self.extents = data_extents(self._fd, self.size)
+        self._starts = [start for start, _ in self.extents]
+        self.data_size = sum(end - start for start, end in self.extents)
+        self.bytes_read = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def fileno(self):
+        return self._fd
+
+    def _overlapping_extents(self, offset, length):
+        end = offset + length
+        index = max(bisect.bisect_right(self._starts, offset) - 1, 0)
+        for start, stop in self.extents[index:]:
+            if start >= end:
+                break
+            if stop > offset:
+                yield max(start, offset), min(stop, end)
+
+    def is_hole(self, offset, length):
+        """
+        Check whether a part of the file holds no data
+        """
+        return next(self._overlapping_extents(offset, length), None) is None
+
+    def read(self, offset, length):
+        """
+        Read a part of the file
+
+        :param offset: start of the part
+        :param length: length of the part, it is clipped to the end of file
+        :return: bytes of the part, or None when the part is a hole and holds only zeros
+        """
+        length = min(length, self.size - offset)
+        extents = list(self._overlapping_extents(offset, length))
+        if not extents:
+            return None
+        if extents == [(offset, offset + length)]:
+            return self._pread(offset, length)
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+        for start, stop in extents:
+            view[start - offset:stop - offset] = self._pread(start, stop - start)
+        return buffer
+
+    def _pread(self, offset, length):
+        chunks = []
+        while length > 0:
+            data = os.pread(self._fd, length, offset)
+            if not data:
+                raise OSError(errno.EIO, f"unexpected end of file at offset {offset}")
+            chunks.append(data)
+            offset += len(data)
+            length -= len(data)
+            self.bytes_read += len(data)
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    def parts(self, chunk_size):
+        """
+        Yield (offset, length, data) for each part of the file, data is None for hole parts
+        """
+        for offset in range(0, self.size, chunk_size):
+            length = min(chunk_size, self.size - offset)
+            yield offset, length, self.read(offset, length)
@@ -0,0 +1,301 @@
+# This module is used for uploading an image to S3 with a single read of the file
+
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError
+from chunk_manifest import ChunkManifest
+from compressed_stream import open_source
+from image_hash import multipart_etag
+from sparse_file import update_with_zeros, zero_bytes, zero_md5, zero_sha256
+from upload_manifest import UploadManifest
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB
+MAX_PART_SIZE = 5 * 1024 * MB
+MAX_PARTS = 10000
+# Large files are split to about this many parts, bigger parts keep each request busy for longer
+TARGET_PARTS = 1000
+
+
+def choose_part_size(file_size, min_part_size):
+    """
+    This function used for choosing the part size of a file, it is never smaller than min_part_size and
+    keeps the number of parts under the S3 limit
+
+    :param file_size: size of the file
+    :param min_part_size: smallest part size to use
+    :return part size in bytes, a multiple of 1 MB
+    """
+    part_size = max(min_part_size, MIN_PART_SIZE, -(-file_size // TARGET_PARTS))
+    part_size = -(-part_size // MB) * MB
+    if part_size > MAX_PART_SIZE or -(-file_size // part_size) > MAX_PARTS:
+        raise ValueError(f"file of {file_size} bytes does not fit in {MAX_PARTS} parts")
+    return part_size
+
+
+def _quote(digest):
+    return f'"{digest.hex()}"'
+
+
+class StreamingUpload:
+    """
+    This class used for uploading a file as a multipart upload. Every part is read once and the
+    same buffer feeds the checksum of the whole file, the md5 of the part and the part upload.
+    Parts that are holes of a sparse file are not read, their md5 and body are shared zero chunks.
+    Parts are uploaded by a pool of workers and recorded in a local manifest, so a failed upload is
+    resumed by sending only the parts that are missing or corrupt on the object storage.
+    With a compressed output format the parts are cut from the compressed stream, the checksum and
+    etag are of the published bytes and raw_checksum is the checksum of the image.
+    With the chunk manifest of the previous version of the object, parts whose sha256 is in it are
+    copied from the previous version on the object storage instead of being uploaded
+    """
+
+    def __init__(self, s3_client, file_path: str, bucket: str, key: str, chunksize: int, metadata: dict = None,
+                 metrics=None, workers: int = 4, manifest_path: str = None, output_format: str = "raw",
+                 compress_workers: int = None, budget=None, previous: ChunkManifest = None):
+        self._s3_client = s3_client
+        self._file_path = file_path
+        self._bucket = bucket
+        self._key = key
+        self._metadata = metadata if metadata is not None else {}
+        # TransferMetrics of the upload
+        self._metrics = metrics
+        self._workers = workers
+        self._output_format = output_format
+        self._compress_workers = compress_workers
+        # TransferBudget shared with other uploads of the process
+        self._budget = budget
+        # ChunkManifest of the object on the object storage, the source of copied parts
+        self._previous = previous
+        self._copy_sources = previous.locations() if previous is not None else dict()
+        self._chunks = dict()
+        file_stat = os.stat(file_path)
+        self.part_size = choose_part_size(file_stat.st_size, chunksize)
+        if manifest_path is None:
+            manifest_path = file_path + ".upload.json"
+        self._manifest = UploadManifest(manifest_path, {"bucket": bucket, "key": key, "size": file_stat.st_size,
+                                                        "mtime": file_stat.st_mtime_ns,
+                                                        "part_size": self.part_size, "format": output_format})
+        self.checksum = None
+        self.raw_checksum = None
+        self.etag = None
+        self.uploaded_parts = 0
+        self.skipped_parts = 0
+        self.copied_parts = 0
+        self.copied_bytes = 0
+        self._copy_lock = threading.Lock()
+
+    def upload(self):
+        """
+        Upload the file and calculate its checksum and expected etag on the way
+
+        :return: True if file was uploaded, else False
+        """
+        try:
+            if self._output_format == "raw" and os.path.getsize(self._file_path) == 0:
+                self._s3_client.put_object(Bucket=self._bucket, Key=self._key, Body=b"", Metadata=self._metadata)
+                self.checksum = self.raw_checksum = hashlib.md5().hexdigest()
+                self.etag = multipart_etag([])
+                return True
+            remote_parts = self._prepare_upload()
+            part_digests = self._upload_parts(remote_parts)
+            parts = [{'ETag': _quote(digest), 'PartNumber': part_number}
+                     for part_number, digest in enumerate(part_digests, start=1)]
+            self._s3_client.complete_multipart_upload(Bucket=self._bucket, Key=self._key,
+                                                      UploadId=self._manifest.upload_id,
+                                                      MultipartUpload={'Parts': parts})
+        except (ClientError, BotoCoreError, OSError) as error:
+            # The multipart upload and the manifest are kept, the next try resumes them
+            logging.error(error)
+            return False
+        finally:
+            self._manifest.close()
+
+        self._manifest.remove()
+        self.etag = multipart_etag(part_digests)
+        return True
+
+    def abort(self):
+        """
+        Abort the multipart upload and delete its manifest, the parts of an incomplete upload are billed until
+        the upload is aborted
+        """
+        if self._manifest.upload_id is None and not self._manifest.load():
+            return
+        self._abort_upload(self._bucket, self._key, self._manifest.upload_id)
+        self._manifest.remove()
+
+    def _abort_upload(self, bucket, key, upload_id):
+        try:
+            self._s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            print(f"Upload {upload_id} of {key} is aborted")
+        except ClientError as error:
+            if error.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+                raise
+
+    def chunk_manifest(self):
+        """
+        :return: ChunkManifest of the uploaded object
+        """
+        chunks = [self._chunks[part_number] for part_number in range(1, len(self._chunks) + 1)]
+        return ChunkManifest(self.part_size, chunks, self.checksum, self.etag)
+
+    def _prepare_upload(self):
+        """
+        Resume the upload of the manifest or start a new one
+
+        :return: etag of the parts already on the object storage by part number
+        """
+        if self._manifest.load():
+            try:
+                remote_parts = self._list_parts()
+                print(f"Resume upload {self._manifest.upload_id}, {len(remote_parts)} parts already uploaded")
+                return remote_parts
+            except ClientError as error:
+                if error.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+                    raise
+        elif self._manifest.stale is not None:
+            # The manifest is of an upload of another image, its parts can not be used
+            bucket, key, upload_id = self._manifest.stale
+            if upload_id is not None:
+                self._abort_upload(bucket, key, upload_id)
+            self._manifest.remove()
+        response = self._s3_client.create_multipart_upload(Bucket=self._bucket, Key=self._key,
+                                                           Metadata=self._metadata)
+        self._manifest.start(response['UploadId'])
+        return dict()
+
+    def _list_parts(self):
+        remote_parts = dict()
+        marker = 0
+        while True:
+            response = self._s3_client.list_parts(Bucket=self._bucket, Key=self._key,
+                                                  UploadId=self._manifest.upload_id, PartNumberMarker=marker)
+            for part in response.get('Parts', []):
+                remote_parts[part['PartNumber']] = part['ETag']
+            if not response.get('IsTruncated'):
+                return remote_parts
+            marker = response['NextPartNumberMarker']
+
+    def _upload_parts(self, remote_parts):
+        """
+        Read the file once, hash it and upload the parts that are not on the object storage yet
+
+        :param remote_parts: etag of the parts already on the object storage by part number
+        :return: md5 digest of each part
+        """
+        md5_hash = hashlib.md5()
+        part_digests = []
+        futures = []
+        failed = threading.Event()
+        # Bounds the number of part buffers held in memory
+        in_flight = threading.BoundedSemaphore(self._workers * 2)
+
+        def part_done(future):
+            if future.exception() is not None:
+                failed.set()
+            in_flight.release()
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor, \
+                open_source(self._file_path, self._output_format, self._compress_workers) as source:
+            for _, length, data in source.parts(self.part_size):
+                if failed.is_set():
+                    break
+                part_sha256 = None
+                if data is None:
+                    update_with_zeros(md5_hash, length)
+                    part_digest = zero_md5(length)
+                    part_sha256 = zero_sha256(length)
+                    data = zero_bytes(length)
+                else:
+                    md5_hash.update(data)
+                    part_digest = hashlib.md5(data).digest()
+                part_digests.append(part_digest)
+                part_number = len(part_digests)
+                if remote_parts.get(part_number) == _quote(part_digest):
+                    self._record_chunk(part_number, data, part_digest, part_sha256)
+                    self._manifest.record_part(part_number, remote_parts[part_number])
+                    self.skipped_parts += 1
+                    self._report(length)
+                    continue
+                # Missing or corrupt on the object storage
+                self._manifest.discard_part(part_number)
+                in_flight.acquire()
+                future = executor.submit(self._upload_part, part_number, data, part_digest, part_sha256)
+                future.add_done_callback(part_done)
+                futures.append(future)
+            for future in futures:
+                future.result()
+            self.raw_checksum = source.raw_checksum if self._output_format != "raw" else md5_hash.hexdigest()
+        self.uploaded_parts = len(futures) - self.copied_parts
+        self.checksum = md5_hash.hexdigest()
+        return part_digests
+
+    def _record_chunk(self, part_number, data, part_digest, part_sha256=None):
+        # The sha256 of a part is calculated by the worker of the part, not by the thread reading the file
+        if part_sha256 is None:
+            part_sha256 = hashlib.sha256(data).hexdigest()
+        self._chunks[part_number] = {"sha256": part_sha256, "md5": part_digest.hex(), "size": len(data)}
+        return part_sha256
+
+    def _upload_part(self, part_number, data, part_digest, part_sha256=None):
+        part_sha256 = self._record_chunk(part_number, data, part_digest, part_sha256)
+        source = self._copy_sources.get(part_sha256)
+        if source is not None and source[1] == len(data) and self._copy_part(part_number, source, part_digest):
+            return
+        with self._budget.part(len(data)) if self._budget is not None else nullcontext():
+            start = time.monotonic()
+            response = self._s3_client.upload_part(Bucket=self._bucket, Key=self._key,
+                                                   UploadId=self._manifest.upload_id, PartNumber=part_number,
+                                                   Body=data, ContentMD5=base64.b64encode(part_digest).decode())
+            latency = time.monotonic() - start
+        self._manifest.record_part(part_number, response['ETag'])
+        if self._metrics is not None:
+            self._metrics.observe_part(latency)
+        self._report(len(data))
+
+    def _copy_part(self, part_number, source, part_digest):
+        """
+        Copy a part from the previous version of the object, the copy is only used when the object is still the
+        one the chunk manifest describes and the copied part has the md5 of the local part
+
+        :param source: (offset, size) of the part in the previous version
+        :return: True if the part was copied, else False and the part is uploaded
+        """
+        offset, length = source
+        copy_source = {'Bucket': self._bucket, 'Key': self._key}
+        if self._previous.version_id is not None:
+            copy_source['VersionId'] = self._previous.version_id
+        start = time.monotonic()
+        try:
+            response = self._s3_client.upload_part_copy(Bucket=self._bucket, Key=self._key,
+                                                        UploadId=self._manifest.upload_id, PartNumber=part_number,
+                                                        CopySource=copy_source,
+                                                        CopySourceRange=f"bytes={offset}-{offset + length - 1}",
+                                                        CopySourceIfMatch=self._previous.etag)
+        except (ClientError, BotoCoreError) as error:
+            print(f"Copy of part {part_number} is not successful, the part is uploaded: {error}")
+            return False
+        latency = time.monotonic() - start
+        etag = response['CopyPartResult']['ETag']
+        if etag != _quote(part_digest):
+            print(f"Copied part {part_number} has etag {etag}, the part is uploaded")
+            return False
+        self._manifest.record_part(part_number, etag)
+        with self._copy_lock:
+            self.copied_parts += 1
+            self.copied_bytes += length
+        if self._metrics is not None:
+            self._metrics.observe_part(latency)
+        self._report(length)
+        return True
+
+    def _report(self, bytes_amount):
+        if self._metrics is not None:
+            self._metrics(bytes_amount)
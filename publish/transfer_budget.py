@@ -0,0 +1,45 @@
+# This module is used for sharing a limit of concurrent parts and bandwidth between uploads
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TransferBudget:
+    """
+    This class used for limiting the number of parts in flight and the upload bandwidth of every upload
+    of the process together
+    """
+
+    def __init__(self, max_parts: int, bytes_per_second: int = 0):
+        """
+        :param max_parts: number of parts uploaded at the same time by all uploads
+        :param bytes_per_second: upload bandwidth of all uploads, 0 is unlimited
+        """
+        self.max_parts = max_parts
+        self._parts = threading.BoundedSemaphore(max_parts)
+        self._bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        # Next time the bandwidth is free, parts reserve their transfer time one after another
+        self._free_at = time.monotonic()
+
+    def _reserve(self, bytes_amount):
+        if self._bytes_per_second <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Unused bandwidth is kept for one second at most
+            start = max(self._free_at, now - 1)
+            self._free_at = start + bytes_amount / self._bytes_per_second
+            delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+    @contextmanager
+    def part(self, bytes_amount):
+        """
+        Wait until a part of bytes_amount bytes can be sent and hold its slot while it is sent
+        """
+        with self._parts:
+            self._reserve(bytes_amount)
+            yield
@@ -0,0 +1,146 @@
+# This module is used for reporting progress and timing metrics of the publish job
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the part latency histogram buckets
+PART_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class TransferMetrics:
+    """
+    This class used for counting uploaded bytes and timing the publish of an image. Every thread counts its
+    bytes in its own counter without taking a lock, and progress is printed at a fixed interval
+    """
+
+    def __init__(self, name: str, size: int, interval: float = 10):
+        """
+        :param name: name of the image in the progress and the metrics
+        :param size: size of the image
+        :param interval: seconds between progress lines, 0 to print no progress
+        """
+        self.name = name
+        self._size = size
+        self._interval = interval
+        self._local = threading.local()
+        self._counters = []
+        self._lock = threading.Lock()
+        self.phases = dict()
+        self._part_buckets = [0] * (len(PART_LATENCY_BUCKETS) + 1)
+        self._part_count = 0
+        self._part_sum = 0.0
+        self._start = time.monotonic()
+        self._stop = threading.Event()
+        self._renderer = None
+
+    def __call__(self, bytes_amount):
+        """
+        :param bytes_amount: uploaded bytes
+        """
+        counter = getattr(self._local, "counter", None)
+        if counter is None:
+            counter = self._local.counter = [0]
+            with self._lock:
+                self._counters.append(counter)
+        counter[0] += bytes_amount
+
+    @property
+    def bytes_done(self):
+        with self._lock:
+            counters = list(self._counters)
+        return sum(counter[0] for counter in counters)
+
+    def observe_part(self, seconds):
+        """
+        Record the latency of a part upload
+        """
+        index = next((index for index, bound in enumerate(PART_LATENCY_BUCKETS) if seconds <= bound),
+                     len(PART_LATENCY_BUCKETS))
+        with self._lock:
+            self._part_buckets[index] += 1
+            self._part_count += 1
+            self._part_sum += seconds
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the publish, the time of a phase run several times is added up
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def start(self):
+        if self._interval > 0:
+            self._renderer = threading.Thread(target=self._render_loop, daemon=True)
+            self._renderer.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._renderer is not None:
+            self._renderer.join()
+            self._render()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _render_loop(self):
+        while not self._stop.wait(self._interval):
+            self._render()
+
+    def _render(self):
+        done = self.bytes_done
+        elapsed = time.monotonic() - self._start
+        percentage = done / self._size * 100 if self._size else 100.0
+        speed = done / elapsed / (1024 * 1024) if elapsed else 0.0
+        print(f"{self.name} {done}/{self._size} ({percentage:.2f}%) {speed:.1f} MB/s", flush=True)
+
+    def to_dict(self):
+        with self._lock:
+            buckets = list(self._part_buckets)
+            part_count = self._part_count
+            part_sum = self._part_sum
+            phases = dict(self.phases)
+        histogram = dict()
+        cumulative = 0
+        for bound, count in zip([str(bound) for bound in PART_LATENCY_BUCKETS] + ["+Inf"], buckets):
+            cumulative += count
+            histogram[bound] = cumulative
+        return {"name": self.name, "size": self._size, "bytes": self.bytes_done,
+                "seconds": time.monotonic() - self._start, "phases": phases,
+                "part_seconds": {"buckets": histogram, "count": part_count, "sum": part_sum}}
+
+    def write_json(self, path):
+        with open(path, 'w') as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2)
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics in the Prometheus text format, for the textfile collector of node exporter
+        """
+        metrics = self.to_dict()
+        image = f'image="{self.name}"'
+        lines = ["# HELP publish_bytes_total Bytes uploaded by the publish job",
+                 "# TYPE publish_bytes_total counter",
+                 f"publish_bytes_total{{{image}}} {metrics['bytes']}",
+                 "# HELP publish_phase_seconds Time spent in each phase of the publish job",
+                 "# TYPE publish_phase_seconds gauge"]
+        for phase, seconds in sorted(metrics["phases"].items()):
+            lines.append(f'publish_phase_seconds{{{image},phase="{phase}"}} {seconds:.3f}')
+        lines += ["# HELP publish_part_seconds Upload time of each part",
+                  "# TYPE publish_part_seconds histogram"]
+        for bound, count in metrics["part_seconds"]["buckets"].items():
+            lines.append(f'publish_part_seconds_bucket{{{image},le="{bound}"}} {count}')
+        lines.append(f"publish_part_seconds_sum{{{image}}} {metrics['part_seconds']['sum']:.3f}")
+        lines.append(f"publish_part_seconds_count{{{image}}} {metrics['part_seconds']['count']}")
+        with open(path, 'w') as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
@@ -3,174 +3,256 @@
 import logging
 import os
 import sys
-import threading
-from typing import Optional
-import hashlib
+import time
 import boto3
-from boto3.s3.transfer import TransferConfig
-from botocore.exceptions import ClientError
-
-
-def calculate_multipart_etag(source_path, chunk_size):
-    """
-    This function used for calculating etag of file
-
-    :param source_path: file path to calculate md5
-    :param chunk_size: size for each part of file
-    :return etag value file
-    """
-    md5s = []
-
-    with open(source_path, 'rb') as file:
-        while True:
-
-            data = file.read(chunk_size)
-            if not data:
-                break
-            md5s.append(hashlib.md5(data))
-    if len(md5s) > 1:
-        digests = b"".join(m.digest() for m in md5s)
-        new_md5 = hashlib.md5(digests)
-        new_etag = f'"{new_md5.hexdigest()}-{len(md5s)}"'
-    elif len(md5s) == 1:  # file smaller than chunk size
-        new_etag = f'"{md5s[0].hexdigest()}"'
-    else:  # empty file
-        new_etag = '""'
-
-    return new_etag
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from chunk_manifest import ChunkManifest
+from compressed_stream import OUTPUT_FORMATS
+from image_hash import calculate_checksum, calculate_checksum_and_etag
+from streaming_upload import MAX_PART_SIZE, StreamingUpload, choose_part_size
+from transfer_metrics import TransferMetrics
 
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# S3 client instance
-s3_client = boto3.client(
-    's3',
-    endpoint_url=os.getenv("s3_endpoint_url"),
-    aws_access_key_id=os.getenv("s3_access_key"),
-    aws_secret_access_key=os.getenv("s3_secret_key")
-)
-
 
-class ProgressPercentage:
+def create_s3_client(max_pool_connections: int = 10):
     """
-    This class used for showing percentage bar when uploading image
-    """
-
-    def __init__(self, _file_path: str):
-        self._file_path = _file_path
-        self._size = float(os.path.getsize(_file_path))
-        self._seen_so_far = 0
-        self._lock = threading.Lock()
+    Create the S3 client, the client is thread safe and is shared by every upload of the process
 
-    def __call__(self, bytes_amount):
-        """
-        To simplify, assume this is hooked up to a single file_path
-
-        :param bytes_amount: uploaded bytes
-        """
-        with self._lock:
-            self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stdout.write(
-                f"\r{self._file_path} {self._seen_so_far}/{self._size} ({percentage:.2f}%)"
-            )
-            sys.stdout.flush()
-
-    def __str__(self):
-        return f"The file path is {self._file_path}"
+    :param max_pool_connections: size of the connection pool of the client
+    """
+    return boto3.client(
+        's3',
+        endpoint_url=os.getenv("s3_endpoint_url"),
+        aws_access_key_id=os.getenv("s3_access_key"),
+        aws_secret_access_key=os.getenv("s3_secret_key"),
+        config=Config(max_pool_connections=max_pool_connections)
+    )
 
 
-def upload_file(file_path: str, bucket: str, object_name: Optional[str] = None, metadata: map = None, chunksize=int):
+def find_unchanged_object(s3_client, file_path: str, bucket: str, object_name: str, chunksize: int,
+                          output_format: str):
     """
-    Upload a file to an S3 bucket
+    Check whether the object on S3 already holds the file, by its checksum tag and etag. A compressed
+    object is compared by the raw_checksum tag, its etag can not be known without compressing the file
 
+    :param s3_client: S3 client
     :param file_path: File to upload
     :param bucket: Bucket to upload to
-    :param object_name: S3 object name. If not specified then file_path is used
-    :return: True if file was uploaded, else False
+    :param object_name: S3 object name
+    :param chunksize: smallest part size of the upload
+    :param output_format: format of the object
+    :return: checksum of the object if it is unchanged, else None
     """
-    # If S3 object_name was not specified, use file_path
-    if object_name is None:
-        object_name = file_path
-
-    # Upload the file
     try:
-        # Set the desired multipart threshold value (400 MB)
-        config = TransferConfig(multipart_chunksize=chunksize)
-        s3_client.upload_file(
-            file_path,
-            bucket,
-            object_name,
-            ExtraArgs={'Metadata': metadata},
-            Callback=ProgressPercentage(file_path),
-            Config=config
-        )
+        head = s3_client.head_object(Bucket=bucket, Key=object_name)
+        tag_set = s3_client.get_object_tagging(Bucket=bucket, Key=object_name)['TagSet']
     except ClientError as error:
+        if error.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+            logging.error(error)
+        return None
+    except BotoCoreError as error:
         logging.error(error)
-        return False
-    return True
+        return None
+    tags = {tag['Key']: tag['Value'] for tag in tag_set}
+    file_size = os.path.getsize(file_path)
+    if output_format != "raw":
+        if 'checksum' not in tags or 'raw_checksum' not in tags:
+            return None
+        print("Image already exists, comparing raw checksum...")
+        raw_checksum = calculate_checksum(file_path, chunksize)
+        print(f"Local raw checksum {raw_checksum}")
+        print(f"Remote raw checksum {tags['raw_checksum']} etag {head['ETag']}")
+        if tags['raw_checksum'] != raw_checksum:
+            return None
+        return tags['checksum']
+    if 'checksum' not in tags or head['ContentLength'] != file_size:
+        return None
+    part_size = choose_part_size(file_size, chunksize)
+    # The etag of a multipart upload ends with its number of parts, a different count is a different upload. An
+    # empty image is uploaded in one request, its etag is its md5
+    if file_size > 0 and not head['ETag'].endswith(f'-{-(-file_size // part_size)}"'):
+        return None
+    print("Image already exists, comparing checksum...")
+    checksum, etag = calculate_checksum_and_etag(file_path, part_size)
+    print(f"Local checksum {checksum} etag {etag}")
+    print(f"Remote checksum {tags['checksum']} etag {head['ETag']}")
+    if tags['checksum'] != checksum or head['ETag'] != etag:
+        return None
+    return checksum
 
 
 KB = 1024
 MB = KB * KB
 
+# Smallest part size, the part size grows with the image so it stays under the parts limit of S3
 MULTIPART_CHUNKSIZE = 15 * MB
-BUCKETNAME = os.getenv("bucketname")
-
-if MULTIPART_CHUNKSIZE < 5 * MB:
-    print("MULTIPART_CHUNKSIZE should not be smaller than 5 MB")
-    sys.exit()
-
-image_path = os.getenv("image_path")
-dir_files = os.path.dirname(image_path)
-dir_files = os.path.abspath(dir_files)
-CHECKSUM = None
-if not os.path.exists(image_path):
-    print("image file does not exists")
-else:
-    DIR = os.getenv("dir") + '/'
-    key_name = DIR + os.getenv("object_name")
-
-    md5_hash = hashlib.md5()
-    with open(image_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            md5_hash.update(byte_block)
-    CHECKSUM = md5_hash.hexdigest()
-
-    RETRY = 3
-    FINISH = False
-    while RETRY >= 1:
-        print("Image uploading...")
-        UPLOAD_SUCCESS = upload_file(image_path, BUCKETNAME, key_name, {}, MULTIPART_CHUNKSIZE)
-        if not UPLOAD_SUCCESS:
-            RETRY -= 1
-            if RETRY == 0:
+RETRY = 3
+
+
+def publish_image(s3_client, image_path: str, bucket: str, key_name: str, output_format: str = "raw",
+                  dedup: bool = False, workers: int = 4, compress_workers: int = None, metrics=None,
+                  budget=None, chunksize: int = MULTIPART_CHUNKSIZE, delta: bool = False):
+    """
+    Upload an image, verify its etag and set its checksum tags
+
+    :param s3_client: S3 client
+    :param image_path: path of raw image
+    :param bucket: Bucket to upload to
+    :param key_name: S3 object name, a compressed output format adds its extension to it
+    :param output_format: one of OUTPUT_FORMATS
+    :param dedup: skip the upload when the object already holds the same image
+    :param workers: number of parts uploaded at the same time
+    :param compress_workers: number of compression processes
+    :param metrics: TransferMetrics of the image, its phases are timed in it
+    :param budget: TransferBudget shared between uploads
+    :param chunksize: smallest part size of the upload
+    :param delta: copy the parts the image shares with the previous version of the object on the object storage
+        and write the chunk manifest of the object next to it
+    :return: dict with result of the publish
+    """
+    if output_format != "raw":
+        key_name += "." + output_format
+    result = {"image": image_path, "key": key_name, "status": "failed", "checksum": None,
+              "size": os.path.getsize(image_path), "seconds": 0.0, "verified_seconds": None,
+              "uploaded_parts": 0, "copied_parts": 0, "copied_bytes": 0}
+    if metrics is None:
+        metrics = TransferMetrics(key_name, result["size"], interval=0)
+    start = time.monotonic()
+    checksum = None
+    raw_checksum = None
+    finish = False
+    unchanged = False
+    previous = None
+    if delta:
+        with metrics.phase("manifest"):
+            previous = ChunkManifest.load(s3_client, bucket, key_name)
+        if previous is not None:
+            print(f"Previous version of {key_name} has {len(previous.chunks)} chunks of {previous.part_size} bytes")
+            # Parts of the same size as the chunks of the previous version are needed to find the shared ones
+            if previous.part_size <= MAX_PART_SIZE:
+                chunksize = max(chunksize, previous.part_size)
+    if dedup:
+        with metrics.phase("hash"):
+            checksum = find_unchanged_object(s3_client, image_path, bucket, key_name, chunksize, output_format)
+        if checksum is not None:
+            print(f"{key_name} is unchanged, upload is skipped")
+            result["verified_seconds"] = time.monotonic() - start
+            finish = True
+            unchanged = True
+    retry = RETRY
+    dir_files = os.path.abspath(os.path.dirname(image_path))
+    while not finish and retry >= 1:
+        print(f"Image {image_path} uploading...")
+        upload = StreamingUpload(s3_client, image_path, bucket, key_name, chunksize, {},
+                                 metrics, workers,
+                                 os.path.join(dir_files, os.path.basename(image_path) + ".upload.json"),
+                                 output_format, compress_workers, budget, previous)
+        with metrics.phase("upload"):
+            upload_success = upload.upload()
+        if not upload_success:
+            retry -= 1
+            if retry == 0:
+                # The parts of the failed upload are not kept on the object storage
+                try:
+                    upload.abort()
+                except (ClientError, BotoCoreError) as error:
+                    logging.error(error)
                 break
             print(" Upload is not successful try again...")
         else:
-            response = s3_client.head_object(Bucket=BUCKETNAME, Key=key_name)
-            etag = response['ETag']
-            etag_calc = calculate_multipart_etag(os.getenv("image_path"), MULTIPART_CHUNKSIZE)
-            if etag == etag_calc:
+            try:
+                with metrics.phase("verify"):
+                    etag = s3_client.head_object(Bucket=bucket, Key=key_name)['ETag']
+            except (ClientError, BotoCoreError) as error:
+                logging.error(error)
+                etag = None
+            if etag == upload.etag:
+                result["verified_seconds"] = time.monotonic() - start
+                checksum = upload.checksum
+                raw_checksum = upload.raw_checksum
+                result["uploaded_parts"] = upload.uploaded_parts
+                result["copied_parts"] = upload.copied_parts
+                result["copied_bytes"] = upload.copied_bytes
                 print(" Upload is done successfully")
-                FINISH = True
+                if previous is not None:
+                    print(f" {upload.copied_parts} parts ({upload.copied_bytes / MB:.0f} MB) are copied from the "
+                          f"previous version, {upload.uploaded_parts} parts are uploaded")
+                finish = True
                 break
             print(" Checking integrity of the file is not successful try again...")
-            RETRY -= 1
+            retry -= 1
 
-    if FINISH:
-        tagging = []
-        DIR = os.getenv("dir") + '/'
-        tagging.append({'Key': 'checksum', 'Value': CHECKSUM})
-        response = s3_client.put_object_tagging(
-            Bucket=BUCKETNAME,
-            Key=key_name,
-            Tagging={
-                'TagSet': tagging
-            },
-        )
-        print("Checksum of image: " + CHECKSUM)
-        print("Checksum tag set on image")
+    if unchanged:
+        print("Checksum of image: " + checksum)
+        print("Checksum tags of the object match the image")
+        result["status"] = "unchanged"
+    elif finish:
+        tagging = [{'Key': 'checksum', 'Value': checksum}]
+        if output_format != "raw":
+            tagging.append({'Key': 'raw_checksum', 'Value': raw_checksum})
+        try:
+            with metrics.phase("tagging"):
+                s3_client.put_object_tagging(
+                    Bucket=bucket,
+                    Key=key_name,
+                    Tagging={
+                        'TagSet': tagging
+                    },
+                )
+            print("Checksum of image: " + checksum)
+            if output_format != "raw":
+                print("Raw checksum of image: " + raw_checksum)
+            print("Checksum tag set on image")
+            if delta:
+                with metrics.phase("manifest"):
+                    upload.chunk_manifest().save(s3_client, bucket, key_name)
+                print("Chunk manifest is written next to image")
+            result["status"] = "uploaded"
+        except (ClientError, BotoCoreError) as error:
+            logging.error(error)
+            print("Setting checksum tag on image is not successful")
     else:
         print("Upload is not successful")
+    result["checksum"] = checksum
+    result["seconds"] = time.monotonic() - start
+    result["metrics"] = metrics.to_dict()
+    return result
+
+
+if __name__ == "__main__":
+    # Skip the upload when the object already holds the same image
+    DEDUP = os.getenv("dedup", "false").lower() == "true"
+    # Copy the parts shared with the previous version of the object instead of uploading them
+    DELTA = os.getenv("delta", "false").lower() == "true"
+    # raw, or zst and qcow2 to publish a compressed image
+    OUTPUT_FORMAT = os.getenv("output_format", "raw")
+    UPLOAD_WORKERS = int(os.getenv("upload_workers", "4"))
+    COMPRESS_WORKERS = int(os.getenv("compress_workers", str(os.cpu_count())))
+    # Seconds between progress lines
+    PROGRESS_INTERVAL = float(os.getenv("progress_interval", "10"))
+    METRICS_PATH = os.getenv("metrics_path", "publish_metrics.json")
+    # Prometheus textfile, not written when it is empty
+    METRICS_TEXTFILE = os.getenv("metrics_textfile", "")
+    BUCKETNAME = os.getenv("bucketname")
+
+    if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+        print(f"output_format should be one of {', '.join(OUTPUT_FORMATS)}")
+        sys.exit(1)
+
+    image_path = os.getenv("image_path")
+    if not os.path.exists(image_path):
+        print("image file does not exists")
+    else:
+        DIR = os.getenv("dir") + '/'
+        key_name = DIR + os.getenv("object_name")
+        s3_client = create_s3_client(UPLOAD_WORKERS)
+        with TransferMetrics(os.getenv("object_name"), os.path.getsize(image_path), PROGRESS_INTERVAL) as metrics:
+            publish_image(s3_client, image_path, BUCKETNAME, key_name, OUTPUT_FORMAT, DEDUP, UPLOAD_WORKERS,
+                          COMPRESS_WORKERS, metrics, delta=DELTA)
+        metrics.write_json(METRICS_PATH)
+        if METRICS_TEXTFILE:
+            metrics.write_prometheus(METRICS_TEXTFILE)
@@ -0,0 +1,98 @@
+# This module is used for persisting the state of a multipart upload to resume it later
+
+import json
+import os
+import threading
+
+
+class UploadManifest:
+    """
+    This class used for recording the upload id and the completed parts of a multipart upload in a local file.
+    The first line of the file describes the upload and every completed or discarded part appends a line to it,
+    so recording a part does not write the whole manifest again
+    """
+
+    def __init__(self, manifest_path: str, source: dict):
+        """
+        :param manifest_path: path of the local manifest file
+        :param source: description of the upload (bucket, key, size and mtime of file, part size), a stored
+                       manifest is only resumed when it describes the same upload
+        """
+        self._manifest_path = manifest_path
+        self._source = source
+        self._lock = threading.Lock()
+        self._file = None
+        self.upload_id = None
+        self.parts = dict()
+        # (bucket, key, upload id) of a stored manifest of another upload, it should be aborted
+        self.stale = None
+
+    def load(self):
+        """
+        Load the stored manifest
+
+        :return: True if a manifest of the same upload was found, else False
+        """
+        try:
+            with open(self._manifest_path, 'r') as manifest_file:
+                header = json.loads(manifest_file.readline())
+                records = []
+                for line in manifest_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # The last line is cut when the process was killed while writing it
+                        break
+        except (OSError, ValueError):
+            return False
+        source = header.get("source", {})
+        if source != self._source:
+            self.stale = (source.get("bucket"), source.get("key"), header.get("upload_id"))
+            return False
+        self.upload_id = header["upload_id"]
+        self.parts = dict()
+        for record in records:
+            if record.get("etag") is None:
+                self.parts.pop(record["part"], None)
+            else:
+                self.parts[record["part"]] = record["etag"]
+        return True
+
+    def start(self, upload_id):
+        with self._lock:
+            self.upload_id = upload_id
+            self.parts = dict()
+            self.stale = None
+            self.close()
+            tmp_path = self._manifest_path + ".tmp"
+            with open(tmp_path, 'w') as manifest_file:
+                json.dump({"source": self._source, "upload_id": upload_id}, manifest_file)
+                manifest_file.write("\n")
+            os.replace(tmp_path, self._manifest_path)
+
+    def record_part(self, part_number, etag):
+        with self._lock:
+            self.parts[part_number] = etag
+            self._append({"part": part_number, "etag": etag})
+
+    def discard_part(self, part_number):
+        with self._lock:
+            if self.parts.pop(part_number, None) is not None:
+                self._append({"part": part_number, "etag": None})
+
+    def remove(self):
+        with self._lock:
+            self.close()
+            if os.path.exists(self._manifest_path):
+                os.remove(self._manifest_path)
+
+    def _append(self, record):
+        if self._file is None:
+            self._file = open(self._manifest_path, 'a')
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
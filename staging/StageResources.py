@@ -1,49 +1,54 @@
 import os
-import openstack
+import json
+import time
 import configparser
+from datetime import datetime, timedelta, timezone
+from image_hash import calculate_checksum
+from openstack_connection import create_openstack_connection, find_id, get_auth_config
+from task_graph import TaskGraph
 
-
-def _create_openstack_connection(auth_url, region_name, project_name, username, password, user_domain_name,
-                                 project_domain_name, interface, endpoint_type):
-    return openstack.connect(
-        auth_url=auth_url,
-        project_name=project_name,
-        username=username,
-        password=password,
-        region_name=region_name,
-        user_domain_name=user_domain_name,
-        project_domain_name=project_domain_name,
-        interface=interface,
-        endpoint_type=endpoint_type
-    )
+MB = 1024 * 1024
+# Tag of staging images kept in Glance to be reused by later pipelines
+CACHE_TAG = "staging-cache"
 
 
 class StageResources:
-    def __init__(self):
-        self.auth_config = {"auth_url": None, "region_name": None, "project_name": None, "username": None,
-                            "password": None, "user_domain_name": "Default", "project_domain_name": "Default",
-                            "interface": "public", "endpoint_type": "publicURL"}
+    def __init__(self, image_name=None, image_path=None, shared=None, evict_cache=None, server_poll_interval=None):
+        """
+        :param image_name: name of image in properties.ini, image_name env by default
+        :param image_path: path of raw image, image_path env by default
+        :param shared: dict of keypair, network and subnet shared with other stagings, they are not created
+        :param evict_cache: evict old cached images after creating one, by default only when nothing is shared,
+                            stagings running side by side leave the eviction to the one which shares the resources
+        :param server_poll_interval: seconds between checks of the server status until it is ACTIVE, the
+                                     openstacksdk default when None
+        """
         self.image_info = dict()
         self.server_info = dict()
-        self._set_auth_config()
-        self._set_image_info()
+        self.auth_config = get_auth_config()
+        self._set_image_info(image_name, image_path)
         self._set_server_info()
-        self.conn = _create_openstack_connection(**self.auth_config)
-        self.keyPair = None
+        self.conn = create_openstack_connection(**self.auth_config)
+        self.shared = shared
+        self.evict_cache = not shared if evict_cache is None else evict_cache
+        self.server_poll_interval = server_poll_interval
+        self.keyPair = shared["keypair"] if shared else None
         self.image = None
         self.server = None
-        self.network = None
-        self.subnet = None
+        self.network = shared["network"] if shared else None
+        self.subnet = shared["subnet"] if shared else None
         self.extra_volume = None
+        self.timings = dict()
+        # Monotonic times of the create_server request and of the server becoming ACTIVE
+        self.server_timestamps = dict()
 
-    def _set_auth_config(self):
-        for k in self.auth_config.keys():
-            if os.getenv(k) is not None:
-                self.auth_config[k] = os.getenv(k)
-
-    def _set_image_info(self):
-        self.image_info["image_path"] = os.getenv("image_path")
-        self.image_info["image_name"] = os.getenv("image_name")
+    def _set_image_info(self, image_name, image_path):
+        self.image_info["image_path"] = image_path or os.getenv("image_path")
+        self.image_info["image_name"] = image_name or os.getenv("image_name")
+        # Number of cached staging images kept in Glance for each image name, 0 disables the cache
+        self.image_info["image_cache_size"] = int(os.getenv("image_cache_size", "3"))
+        # Cached images younger than this may be about to boot a server of another pipeline, they are not evicted
+        self.image_info["image_cache_grace_minutes"] = int(os.getenv("image_cache_grace_minutes", "60"))
 
     def _set_server_info(self):
         if os.getenv("flavor_name") is not None:
@@ -60,13 +65,70 @@ class StageResources:
             self.server_info["server_root_size"] = "25"
 
     def _create_image(self):
-        print(f'Create image {self.image_info["image_name"]}')
         properties = configparser.ConfigParser()
         properties.read('staging/properties.ini')
+        self.image_info["image_username"] = properties[self.image_info["image_name"]]["username"]
+        if self.image_info["image_cache_size"] > 0:
+            checksum = calculate_checksum(self.image_info["image_path"], 16 * MB)
+            self.image = self._find_cached_image(checksum)
+            if self.image is not None:
+                print(f'Reuse cached image {self.image.id} of {self.image_info["image_name"]}')
+                return
+            tags = ['personal', CACHE_TAG, f'checksum-{checksum}']
+        else:
+            checksum = None
+            tags = ['personal']
+        print(f'Create image {self.image_info["image_name"]}')
         self.image = self.conn.create_image(name=self.image_info["image_name"], filename=self.image_info["image_path"],
                                             allow_duplicates=True, disk_format='raw', visibility='private',
-                                            tags=['personal'], meta=properties[self.image_info["image_name"]])
-        self.image_info["image_username"] = properties[self.image_info["image_name"]]["username"]
+                                            tags=tags, md5=checksum, meta=properties[self.image_info["image_name"]])
+        if self.image_info["image_cache_size"] > 0 and self.evict_cache:
+            self.evict_cached_images()
+
+    def _find_cached_image(self, checksum):
+        """
+        Find an active cached image with the checksum of the raw image
+        """
+        for image in self.conn.image.images(visibility='private', tag=[f'checksum-{checksum}'], status='active'):
+            if image.checksum == checksum and image.name == self.image_info["image_name"]:
+                return image
+        return None
+
+    def _images_in_use(self):
+        """
+        Ids of the images servers boot from, directly or through a volume created from the image
+        """
+        in_use = {server.image.id for server in self.conn.compute.servers() if server.image and server.image.id}
+        for volume in self.conn.block_storage.volumes():
+            image_id = (volume.volume_image_metadata or {}).get("image_id")
+            if image_id:
+                in_use.add(image_id)
+        return in_use
+
+    def evict_cached_images(self, image_names=None):
+        """
+        Delete the oldest cached images so only image_cache_size of them are kept for each image name. Images
+        younger than the grace period, images servers still use and the image of this staging are kept
+
+        :param image_names: names of the images to evict cached images of, the image of this staging by default
+        """
+        image_names = image_names or [self.image_info["image_name"]]
+        grace_start = datetime.now(timezone.utc) - timedelta(minutes=self.image_info["image_cache_grace_minutes"])
+        keep_ids = {self.image.id} if self.image is not None else set()
+        try:
+            in_use = self._images_in_use()
+            for image_name in image_names:
+                cached = sorted(self.conn.image.images(visibility='private', name=image_name, tag=[CACHE_TAG]),
+                                key=lambda image: image.created_at, reverse=True)
+                for image in cached[self.image_info["image_cache_size"]:]:
+                    created_at = datetime.fromisoformat(image.created_at.rstrip("Z")).replace(tzinfo=timezone.utc)
+                    if image.id in keep_ids or image.id in in_use or created_at > grace_start:
+                        continue
+                    print(f"Evict cached image {image.id} {image.name}")
+                    self.conn.image.delete_image(image.id, ignore_missing=True)
+        except Exception as error:
+            # The cache is only trimmed again by the next staging, it does not fail this one
+            print(f"Evicting cached images failed: {error}")
 
     def _create_keypair(self):
         print(f"Create keypair gitlab-runner-ssh-key")
@@ -77,16 +139,23 @@ class StageResources:
 
     def _create_server(self):
         print(f"Create server {self.image_info['image_name']}")
-        flavor = self.conn.compute.find_flavor(self.server_info["flavor_name"])
-        network = self.conn.network.find_network(self.server_info["public_network_name"])
+        flavor_id = find_id(self.conn, "flavor", self.server_info["flavor_name"])
+        network_id = find_id(self.conn, "network", self.server_info["public_network_name"])
         block_device_mapping_v2 = [{"boot_index": "0", "uuid": self.image.id,
                                     "source_type": "image", "volume_size": self.server_info["server_root_size"],
                                     "destination_type": "volume", "delete_on_termination": True, "disk_bus": "virtio"}]
+        self.server_timestamps["created"] = time.monotonic()
         server = self.conn.compute.create_server(name=self.image_info["image_name"],
                                                  block_device_mapping=block_device_mapping_v2,
-                                                 flavor_id=flavor.id, networks=[{"uuid": network.id}],
+                                                 flavor_id=flavor_id, networks=[{"uuid": network_id}],
                                                  key_name=self.keyPair.name)
-        self.server = self.conn.compute.wait_for_server(server)
+        # Kept before the wait so a server that does not become active is still cleaned up
+        self.server = server
+        if self.server_poll_interval is None:
+            self.server = self.conn.compute.wait_for_server(server)
+        else:
+            self.server = self.conn.compute.wait_for_server(server, interval=self.server_poll_interval)
+        self.server_timestamps["active"] = time.monotonic()
 
     def _create_private_network(self):
         print(f"Create network {self.image_info['image_name']}_network")
@@ -102,22 +171,69 @@ class StageResources:
         self.extra_volume = self.conn.block_storage.create_volume(name=f"{self.image_info['image_name']}_extra_volume",
                                                                   size=5)
 
+    def resource_info(self):
+        """
+        Ids of the staged resources, in the variables of stage.env
+        """
+        return {"IMAGE_ID": self.image.id, "SERVER_ID": self.server.id,
+                "SERVER_USERNAME": self.image_info["image_username"],
+                "SERVER_IP": self.server.addresses[self.server_info["public_network_name"]][0]['addr'],
+                "KEYPAIR_ID": self.keyPair.id, "SERVER_NAME": self.image_info["image_name"],
+                "NETWORK_ID": self.network.id, "SUBNET_ID": self.subnet.id, "EXTRA_VOLUME_ID": self.extra_volume.id}
+
+    def staged_ids(self):
+        """
+        Ids of the resources created by this staging so far, shared resources are not included
+        """
+        resources = {"image_id": self.image, "server_id": self.server, "extra_volume_id": self.extra_volume}
+        if not self.shared:
+            resources.update({"keypair_id": self.keyPair, "network_id": self.network, "subnet_id": self.subnet})
+        return {name: resource.id for name, resource in resources.items() if resource is not None}
+
     def _save_resource_info(self):
-        stg_env = ["IMAGE_ID=" + self.image.id + "\n", "SERVER_ID=" + self.server.id + "\n",
-                   "SERVER_USERNAME=" + self.image_info["image_username"] + "\n", "SERVER_IP=" +
-                   self.server.addresses[self.server_info["public_network_name"]][0]['addr'] + "\n",
-                   "KEYPAIR_ID=" + self.keyPair.id + "\n", "SERVER_NAME=" + self.image_info["image_name"] + "\n",
-                       "NETWORK_ID=" + self.network.id + "\n", "SUBNET_ID=" + self.subnet.id + "\n", "EXTRA_VOLUME_ID=" +
-                   self.extra_volume.id + "\n"]
+        stg_env = [f"{name}={value}\n" for name, value in self.resource_info().items()]
         with open("stage.env", 'w') as stage:
             stage.writelines(stg_env)
 
-    def stage_resources(self):
-        print("Stage resources:")
-        self._create_image()
-        self._create_keypair()
-        self._create_server()
-        self._create_private_network()
-        self._create_subnet_network()
-        self._create_extra_volume()
-        self._save_resource_info()
+    def stage_shared_resources(self):
+        """
+        Create the keypair, network and subnet shared by the stagings of several images
+        """
+        print("Stage shared resources:")
+        graph = TaskGraph()
+        graph.add("keypair", self._create_keypair)
+        graph.add("network", self._create_private_network)
+        graph.add("subnet", self._create_subnet_network, depends_on=["network"])
+        try:
+            graph.run()
+        finally:
+            self.timings = graph.timings
+        return {"keypair": self.keyPair, "network": self.network, "subnet": self.subnet}
+
+    def stage_resources(self, timings_path="stage_timings.json", save=True):
+        """
+        :param timings_path: file to write the step timings to, None to not write them
+        :param save: write the ids of resources to stage.env
+        """
+        print(f"Stage resources of {self.image_info['image_name']}:")
+        # Only the server waits for the image upload, the other resources are created meanwhile
+        graph = TaskGraph()
+        graph.add("image", self._create_image)
+        graph.add("extra_volume", self._create_extra_volume)
+        if self.shared:
+            graph.add("server", self._create_server, depends_on=["image"])
+        else:
+            graph.add("keypair", self._create_keypair)
+            graph.add("network", self._create_private_network)
+            graph.add("subnet", self._create_subnet_network, depends_on=["network"])
+            graph.add("server", self._create_server, depends_on=["image", "keypair"])
+        try:
+            graph.run()
+        finally:
+            self.timings = graph.timings
+            graph.print_timings()
+            if timings_path is not None:
+                with open(timings_path, 'w') as timings:
+                    json.dump(graph.timings, timings, indent=2)
+        if save:
+            self._save_resource_info()
@@ -0,0 +1,232 @@
+# This script is used for measuring the boot time of images
+# Every image is staged on its own server like in the matrix mode, the time from create_server to ACTIVE, to SSH
+# reachable and to cloud-init finished is recorded with the systemd-analyze critical chain of the guest. Results are
+# stored per image and build and compared against a baseline, an image slower than its threshold fails the job.
+# The baseline is made of measured runs: a run with boot_update_baseline writes it as an artifact to be committed.
+# Until an image has its own baseline it is compared to the default one, which holds the limits staging waited for
+# before it measured anything: 120s for ACTIVE and 210s for SSH. An image without any baseline is reported as
+# no-baseline
+#
+# PYTHONPATH=publish:common:staging:cleanup:test python3 test/boot_perf.py
+
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fabric import Connection
+from console_log import ConsoleLog
+from matrix import cleanup, get_image_names
+from readiness import WaitTimeout, wait_until
+from StageResources import StageResources
+from vm_test_actions import connect_to_gateway
+
+# Seconds from create_server, compared against the baseline
+METRICS = ("active", "ssh", "cloud_init")
+# Final message of cloud-init on the console, with the uptime of the guest
+CLOUD_INIT_FINISHED = re.compile(r"Cloud-init v\. \S+ finished at .* Up ([\d.]+) seconds")
+LOGIN_PROMPT = re.compile(r"\slogin:\s*$")
+
+
+def measure_boot(staging, ssh_info, timeout=600):
+    """
+    Measure the boot of a staged server, the times are in seconds from the create_server request
+
+    :param staging: StageResources of the server
+    :param ssh_info: gateway_username, gateway_ip, gateway_port and ssh_key_path
+    :param timeout: seconds to wait for each step of the boot
+    :return: dict with times of the boot
+    """
+    created = staging.server_timestamps["created"]
+    boot = {"active": staging.server_timestamps["active"] - created, "ssh": None, "cloud_init": None,
+            "console_login": None, "cloud_init_uptime": None, "cloud_init_status": None, "systemd_time": None,
+            "critical_chain": None}
+    console_log = ConsoleLog(staging.conn, staging.server.id)
+    server_ip = staging.resource_info()["SERVER_IP"]
+    gateway = connect_to_gateway(ssh_info["gateway_username"], ssh_info["gateway_ip"], ssh_info["gateway_port"],
+                                 ssh_info["ssh_key_path"])
+
+    def read_console():
+        for line in console_log.read():
+            if boot["console_login"] is None and LOGIN_PROMPT.search(line):
+                boot["console_login"] = time.monotonic() - created
+            finished = CLOUD_INIT_FINISHED.search(line)
+            if finished:
+                boot["cloud_init_uptime"] = float(finished.group(1))
+
+    def ssh_ready():
+        read_console()
+        connection = Connection(user=staging.image_info["image_username"], host=server_ip, gateway=gateway,
+                                connect_timeout=10, connect_kwargs={"key_filename": ssh_info["ssh_key_path"]})
+        connection.run("true", hide=True)
+        return connection
+
+    # Short delays between tries, the time of the try which succeeds is the measured time
+    connection = wait_until(f"ssh on {server_ip}", ssh_ready, timeout=timeout, max_delay=2, jitter=0)
+    boot["ssh"] = time.monotonic() - created
+    status = connection.run("cloud-init status --wait", hide=True, warn=True, timeout=timeout)
+    boot["cloud_init"] = time.monotonic() - created
+    boot["cloud_init_status"] = status.stdout.strip()
+
+    def systemd_time():
+        # systemd-analyze fails until every unit of the boot is started
+        analyze = connection.run("systemd-analyze time", hide=True, warn=True)
+        return analyze.stdout.strip() if analyze.ok else None
+
+    try:
+        boot["systemd_time"] = wait_until("systemd boot", systemd_time, timeout=120)
+    except WaitTimeout:
+        print(f"Boot of {server_ip} is not finished for systemd")
+    boot["critical_chain"] = connection.run("systemd-analyze critical-chain --no-pager", hide=True,
+                                            warn=True).stdout.strip()
+    read_console()
+    connection.close()
+    gateway.close()
+    return boot
+
+
+def load_baseline(baseline_path):
+    if not os.path.exists(baseline_path):
+        return dict()
+    with open(baseline_path, 'r') as baseline_file:
+        return json.load(baseline_file)
+
+
+def compare_to_baseline(result, baseline, factor, slack):
+    """
+    :param result: result of an image
+    :param baseline: seconds of each metric by image name, default for images without their own baseline
+    :param factor: allowed growth of a metric over its baseline
+    :param slack: seconds allowed over the baseline on top of the factor, for the noise of short boots
+    :return: list of metrics over their threshold, None when the image has no baseline for its metrics
+    """
+    expected = baseline.get(result["image"], baseline.get("default", {}))
+    if not any(metric in expected and result["boot"].get(metric) is not None for metric in METRICS):
+        return None
+    regressions = []
+    for metric in METRICS:
+        value = result["boot"].get(metric)
+        if value is None or metric not in expected:
+            continue
+        threshold = expected[metric] * factor + slack
+        if value > threshold:
+            regressions.append(f"{metric} {value:.1f}s > {threshold:.1f}s")
+    return regressions
+
+
+def measure_image(image_name, image_dir, shared, ssh_info):
+    """
+    Stage an image, measure its boot and delete its resources
+
+    :return: dict with result of the image
+    """
+    result = {"image": image_name, "status": "failed", "boot": {}, "regressions": [], "error": None,
+              "cleaned_up": True}
+    image_path = os.path.join(image_dir, f"{image_name}.raw")
+    if not os.path.exists(image_path):
+        result["status"] = "missing"
+        result["error"] = f"{image_path} does not exist"
+        return result
+    staging = None
+    try:
+        # The server status is checked every second, so the time to ACTIVE is measured to the second
+        staging = StageResources(image_name, image_path, shared, server_poll_interval=1)
+        staging.stage_resources(timings_path=None, save=False)
+        result["boot"] = measure_boot(staging, ssh_info)
+        result["status"] = "measured"
+    except Exception as error:
+        result["error"] = str(error)
+        print(f"Boot measurement of {image_name} failed: {error}")
+    finally:
+        if staging is not None:
+            result["cleaned_up"] = cleanup(image_name, staging.staged_ids())
+    return result
+
+
+def save_result(result, results_dir, build_id):
+    """
+    Results are kept in results_dir/IMAGE/BUILD.json
+    """
+    image_dir = os.path.join(results_dir, result["image"])
+    os.makedirs(image_dir, exist_ok=True)
+    with open(os.path.join(image_dir, f"{build_id}.json"), 'w') as result_file:
+        json.dump(dict(result, build=build_id), result_file, indent=2)
+
+
+def update_baseline(baseline, results):
+    for result in results:
+        if result["status"] in ("passed", "slow", "no-baseline"):
+            baseline[result["image"]] = {metric: round(result["boot"][metric], 1) for metric in METRICS
+                                         if result["boot"].get(metric) is not None}
+    return baseline
+
+
+def print_report(results):
+    print("Boot time report:")
+    for result in results:
+        boot = result["boot"]
+        line = f"{result['image']}: {result['status']}"
+        times = [f"{metric} {boot[metric]:.1f}s" for metric in METRICS if boot.get(metric) is not None]
+        if times:
+            line += " " + ", ".join(times)
+        if boot.get("systemd_time"):
+            line += f" ({boot['systemd_time'].splitlines()[0]})"
+        if result["regressions"]:
+            line += f" over threshold: {', '.join(result['regressions'])}"
+        if result["error"]:
+            line += f" error: {result['error']}"
+        print(line)
+
+
+if __name__ == "__main__":
+    # Comma separated image names, all for every image in properties.ini
+    IMAGES = os.getenv("images", "all")
+    IMAGE_DIR = os.getenv("image_dir", "/var/os-images")
+    # Servers booting at the same time slow each other down, one at a time keeps the results comparable
+    BOOT_WORKERS = int(os.getenv("boot_workers", "1"))
+    BUILD_ID = os.getenv("build_id", os.getenv("CI_PIPELINE_ID", time.strftime("%Y%m%d%H%M%S")))
+    RESULTS_DIR = os.getenv("boot_results_dir", "boot_results")
+    BASELINE_PATH = os.getenv("boot_baseline_path", "test/boot_baseline.json")
+    REGRESSION_FACTOR = float(os.getenv("boot_regression_factor", "1.25"))
+    REGRESSION_SLACK = float(os.getenv("boot_regression_slack", "10"))
+    # Write the baseline with the measured times to boot_baseline_output instead of failing on them, the file is
+    # an artifact of the job to be reviewed and committed to boot_baseline_path
+    UPDATE_BASELINE = os.getenv("boot_update_baseline", "false").lower() == "true"
+    BASELINE_OUTPUT = os.getenv("boot_baseline_output", "boot_baseline.json")
+    REPORT_PATH = os.getenv("report_path", "boot_report.json")
+    SSH_INFO = {"gateway_username": os.getenv("GATEWAY_USERNAME"), "gateway_ip": os.getenv("GATEWAY_IP"),
+                "gateway_port": os.getenv("GATEWAY_PORT"), "ssh_key_path": os.getenv("SSH_PRIVATE_KEY_PATH")}
+
+    baseline = load_baseline(BASELINE_PATH)
+    shared_staging = StageResources(image_name="boot")
+    try:
+        shared = shared_staging.stage_shared_resources()
+        with ThreadPoolExecutor(max_workers=BOOT_WORKERS) as executor:
+            image_names = get_image_names(IMAGES, "staging/properties.ini")
+            results = list(executor.map(lambda name: measure_image(name, IMAGE_DIR, shared, SSH_INFO), image_names))
+        if shared_staging.image_info["image_cache_size"] > 0:
+            shared_staging.evict_cached_images(image_names)
+    finally:
+        cleanup("shared resources", shared_staging.staged_ids())
+
+    for result in results:
+        if result["status"] == "measured":
+            regressions = compare_to_baseline(result, baseline, REGRESSION_FACTOR, REGRESSION_SLACK)
+            if regressions is None:
+                result["status"] = "no-baseline"
+            else:
+                result["regressions"] = regressions
+                result["status"] = "slow" if regressions else "passed"
+        save_result(result, RESULTS_DIR, BUILD_ID)
+    print_report(results)
+    with open(REPORT_PATH, 'w') as report_file:
+        json.dump(results, report_file, indent=2)
+    if UPDATE_BASELINE:
+        new_baseline = json.dumps(update_baseline(baseline, results), indent=2, sort_keys=True)
+        with open(BASELINE_OUTPUT, 'w') as baseline_file:
+            baseline_file.write(new_baseline + "\n")
+        print(f"Baseline is written to {BASELINE_OUTPUT}, commit it to {BASELINE_PATH} to use it:")
+        print(new_baseline)
+    elif any(result["status"] not in ("passed", "no-baseline") or not result["cleaned_up"] for result in results):
+        sys.exit(1)
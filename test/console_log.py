@@ -0,0 +1,66 @@
+# This module is used for reading the console log of a server without fetching all of it on every read
+
+# Lines of the log read before the new lines, they are looked up in the tail of the log to find where it continues
+ANCHOR_LINES = 5
+
+
+class ConsoleLog:
+    """
+    This class used for reading the console log of a server incrementally. The compute API returns the last
+    lines of the log, so a read fetches a tail of the log and keeps the lines after the offset of the last read.
+    The tail grows until it reaches the lines already read, the whole log is only fetched on the first read or
+    when the lines already read are not found in it
+    """
+
+    def __init__(self, conn, server_id, window=100):
+        """
+        :param conn: openstack connection
+        :param server_id: id of server
+        :param window: number of lines fetched by a read, it doubles while the new lines do not fit in it
+        """
+        self._conn = conn
+        self._server_id = server_id
+        self._window = window
+        self.lines = []
+
+    @property
+    def offset(self):
+        # Number of lines read
+        return len(self.lines)
+
+    @property
+    def text(self):
+        return "\n".join(self.lines)
+
+    def _tail(self, length):
+        output = self._conn.compute.get_server_console_output(self._server_id, length=length)['output']
+        lines = output.splitlines()
+        # The last line is read again when it is complete
+        if lines and not output.endswith("\n"):
+            lines.pop()
+        return lines
+
+    def _new_lines(self, tail, length):
+        if length is None or len(tail) < length:
+            # The tail is the whole log, the new lines start at the offset unless the log was rotated
+            if len(tail) >= self.offset and tail[:self.offset][-ANCHOR_LINES:] == self.lines[-ANCHOR_LINES:]:
+                return tail[self.offset:]
+        anchor = self.lines[-ANCHOR_LINES:]
+        for start in range(len(tail) - len(anchor), -1, -1):
+            if tail[start:start + len(anchor)] == anchor:
+                return tail[start + len(anchor):]
+        # The lines already read are not in the tail
+        return tail if length is None else None
+
+    def read(self):
+        """
+        :return: lines added to the log since the last read
+        """
+        length = self._window if self.lines else None
+        while True:
+            tail = self._tail(length)
+            new_lines = self._new_lines(tail, length)
+            if new_lines is not None:
+                self.lines.extend(new_lines)
+                return new_lines
+            length = length * 2 if length < self._window * 64 else None
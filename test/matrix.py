@@ -0,0 +1,149 @@
+# This script is used for validating several images at the same time
+# Every image is staged on its own server, the keypair, network and subnet are shared between them, the TestVM
+# suite runs against each server and every staged resource is deleted at the end, even on failure
+#
+# PYTHONPATH=publish:staging:cleanup:test python3 test/matrix.py
+
+import configparser
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from resources import Resources
+from StageResources import StageResources
+
+TEST_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.py")
+
+
+def get_image_names(images, properties_path):
+    """
+    :param images: comma separated image names, all for every image in properties.ini
+    :param properties_path: path of properties.ini
+    """
+    if images == "all":
+        properties = configparser.ConfigParser()
+        properties.read(properties_path)
+        return properties.sections()
+    return [name.strip() for name in images.split(",") if name.strip()]
+
+
+def run_tests(resource_info):
+    """
+    Run the TestVM suite against a staged server in its own process
+
+    :param resource_info: variables of stage.env of the server
+    :return: dict with report of the tests
+    """
+    with tempfile.TemporaryDirectory() as report_dir:
+        report_path = os.path.join(report_dir, "report.json")
+        env = dict(os.environ, TEST_REPORT_PATH=report_path, **resource_info)
+        completed = subprocess.run([sys.executable, TEST_SCRIPT], env=env, capture_output=True, text=True)
+        report = {"returncode": completed.returncode}
+        if os.path.exists(report_path):
+            with open(report_path, 'r') as report_file:
+                report.update(json.load(report_file))
+    # The output of every server is printed in one piece so parallel runs do not interleave
+    print(f"Tests of {resource_info['SERVER_NAME']}:\n{completed.stdout}{completed.stderr}", flush=True)
+    return report
+
+
+def cleanup(name, resource_ids):
+    try:
+        Resources(**resource_ids).delete_resources()
+    except Exception as error:
+        print(f"Cleanup of {name} failed: {error}")
+        return False
+    return True
+
+
+def validate_image(image_name, image_dir, shared):
+    """
+    Stage an image, run the tests against it and delete its resources
+
+    :param image_name: name of image in properties.ini
+    :param image_dir: directory of raw images
+    :param shared: keypair, network and subnet shared by the images
+    :return: dict with result of the image
+    """
+    result = {"image": image_name, "status": "failed", "stage_seconds": None, "test_seconds": None,
+              "tests": None, "error": None, "cleaned_up": True}
+    image_path = os.path.join(image_dir, f"{image_name}.raw")
+    if not os.path.exists(image_path):
+        result["status"] = "missing"
+        result["error"] = f"{image_path} does not exist"
+        return result
+    staging = None
+    start = time.monotonic()
+    try:
+        staging = StageResources(image_name, image_path, shared)
+        staging.stage_resources(timings_path=None, save=False)
+        result["stage_seconds"] = time.monotonic() - start
+        start = time.monotonic()
+        result["tests"] = run_tests(staging.resource_info())
+        result["test_seconds"] = time.monotonic() - start
+        result["status"] = "passed" if result["tests"]["returncode"] == 0 else "failed"
+    except Exception as error:
+        result["error"] = str(error)
+        print(f"Validation of {image_name} failed: {error}")
+    finally:
+        if staging is not None:
+            result["stage_timings"] = staging.timings
+            result["cleaned_up"] = cleanup(image_name, staging.staged_ids())
+    return result
+
+
+def validate_images(image_names, image_dir, workers):
+    """
+    :param image_names: names of images in properties.ini
+    :param image_dir: directory of raw images
+    :param workers: number of images staged and tested at the same time
+    :return: list of results of images
+    """
+    shared_staging = StageResources(image_name="matrix")
+    try:
+        shared = shared_staging.stage_shared_resources()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda name: validate_image(name, image_dir, shared), image_names))
+        # The images are staged side by side, their cached images are evicted once all of them are done
+        if shared_staging.image_info["image_cache_size"] > 0:
+            shared_staging.evict_cached_images(image_names)
+        return results
+    finally:
+        cleanup("shared resources", shared_staging.staged_ids())
+
+
+def print_report(results):
+    print("Matrix report:")
+    for result in results:
+        tests = result["tests"] or {}
+        failed = tests.get("failures", []) + tests.get("errors", [])
+        line = f"{result['image']}: {result['status']}"
+        if result["stage_seconds"] is not None:
+            line += f" staged in {result['stage_seconds']:.1f}s"
+        if result["test_seconds"] is not None:
+            line += f" tested in {result['test_seconds']:.1f}s ({tests.get('tests_run', 0)} tests)"
+        if failed:
+            line += f" failed tests: {', '.join(failed)}"
+        if result["error"]:
+            line += f" error: {result['error']}"
+        if not result["cleaned_up"]:
+            line += " cleanup failed"
+        print(line)
+
+
+if __name__ == "__main__":
+    # Comma separated image names, all for every image in properties.ini
+    IMAGES = os.getenv("images", "all")
+    IMAGE_DIR = os.getenv("image_dir", "/var/os-images")
+    MATRIX_WORKERS = int(os.getenv("matrix_workers", "4"))
+    REPORT_PATH = os.getenv("report_path", "matrix_report.json")
+
+    results = validate_images(get_image_names(IMAGES, "staging/properties.ini"), IMAGE_DIR, MATRIX_WORKERS)
+    print_report(results)
+    with open(REPORT_PATH, 'w') as report_file:
+        json.dump(results, report_file, indent=2)
+    if any(result["status"] != "passed" or not result["cleaned_up"] for result in results):
+        sys.exit(1)
@@ -0,0 +1,75 @@
+# This module is used for waiting until staged resources and guests are ready, without fixed sleeps
+
+import random
+import time
+from invoke.exceptions import Failure
+from openstack.exceptions import SDKException
+from paramiko import SSHException
+
+# Errors of a resource or guest which is not ready yet: refused or dropped connections, failed remote
+# commands and errors of the OpenStack API. Other errors are bugs and are raised at once
+NOT_READY_ERRORS = (OSError, EOFError, SSHException, Failure, SDKException)
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+def wait_until(description, condition, timeout=300, initial_delay=1, max_delay=15, factor=2, jitter=0.25,
+               not_ready_errors=NOT_READY_ERRORS):
+    """
+    This function used for polling a condition with exponential backoff and jitter until it holds or the
+    deadline passes. An exception of not_ready_errors raised by the condition counts as not ready, other
+    exceptions and WaitTimeout stop the wait
+
+    :param description: what is waited for, used in the log
+    :param condition: function returning a truthy value when ready
+    :param timeout: seconds before giving up
+    :param initial_delay: seconds before the second try
+    :param max_delay: largest delay between tries
+    :param factor: growth of the delay after each try
+    :param jitter: fraction of the delay added or removed at random
+    :param not_ready_errors: exceptions of the condition which mean it does not hold yet
+    :return: value returned by the condition
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = initial_delay
+    attempts = 0
+    last_error = None
+    while True:
+        attempts += 1
+        try:
+            value = condition()
+            if value:
+                print(f"{description} is ready after {time.monotonic() - start:.1f}s ({attempts} attempts)")
+                return value
+        except not_ready_errors as error:
+            last_error = error
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            elapsed = time.monotonic() - start
+            print(f"{description} is not ready after {elapsed:.1f}s ({attempts} attempts)")
+            raise WaitTimeout(f"{description} is not ready after {elapsed:.1f}s: {last_error}")
+        time.sleep(min(remaining, delay * random.uniform(1 - jitter, 1 + jitter)))
+        delay = min(max_delay, delay * factor)
+
+
+def wait_for_status(description, fetch, status, timeout=300, failed_status=("ERROR",)):
+    """
+    This function used for waiting until an OpenStack resource reaches a status
+
+    :param description: what is waited for, used in the log
+    :param fetch: function returning the resource, it should have a status attribute
+    :param status: status to wait for
+    :param timeout: seconds before giving up
+    :param failed_status: statuses that will not change to the waited one
+    :return: the resource
+    """
+    def reached():
+        resource = fetch()
+        if resource.status in failed_status:
+            raise WaitTimeout(f"{description} is in status {resource.status}")
+        return resource if resource.status == status else None
+
+    return wait_until(description, reached, timeout)
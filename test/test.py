@@ -1,4 +1,6 @@
+import json
 import os
+import sys
 import unittest
 from vm_test_actions import VmTestActions
 
@@ -23,24 +25,26 @@ class TestVM(unittest.TestCase):
         conn_info = get_info_connection()
         cls.resource_info = get_info_resources()
         cls.vmAct = VmTestActions(**conn_info)
+        # Facts of the guest before any test changes the server, read-only tests assert against them
+        cls.facts = dict(cls.vmAct.get_facts())
 
     def test_interface_name(self):
-        interface_names = self.vmAct.get_interfaces_name()
+        interface_names = self.facts["interfaces"]
         self.assertIn("eth0", interface_names)
 
     def test_hostname_change(self):
-        hostname = self.vmAct.get_hostname()
+        hostname = self.facts["hostname"]
         server_name = self.resource_info['server_name']
         server_name = server_name.lower().replace('.', '-')
         server_name_regex = ".*" + server_name + ".*"
         self.assertRegex(hostname, server_name_regex)
 
     def test_internet_connectivity(self):
-        check = self.vmAct.ping_internet()
+        check = self.facts["ping"]
         self.assertIn("0% packet loss", check, msg="Internet connection has problem")
 
     def test_partition_table(self):
-        pt = self.vmAct.get_partition_table()
+        pt = self.facts["partition_table"]
         self.assertRegex(pt, "GPT .*", msg="Partition table is not GPT")
 
     def test_console_log(self):
@@ -65,4 +69,18 @@ class TestVM(unittest.TestCase):
         self.assertNotEqual(password, "ERROR", msg="Change password is not successful")
 
 
-unittest.main()
+def write_report(result, report_path):
+    report = {"tests_run": result.testsRun, "successful": result.wasSuccessful(),
+              "failures": [test.id() for test, _ in result.failures],
+              "errors": [test.id() for test, _ in result.errors],
+              "skipped": [test.id() for test, _ in result.skipped]}
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    test_result = unittest.main(exit=False).result
+    # Path of a JSON report of the run, the matrix mode reads it
+    if os.getenv("TEST_REPORT_PATH"):
+        write_report(test_result, os.getenv("TEST_REPORT_PATH"))
+    sys.exit(0 if test_result.wasSuccessful() else 1)
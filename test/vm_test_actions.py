@@ -1,27 +1,39 @@
 from fabric import Connection
-import time
-import openstack
-import os
 import random
 import string
-
-
-def _create_openstack_connection(auth_url, region_name, project_name, username, password, user_domain_name,
-                                 project_domain_name, interface, endpoint_type):
-    return openstack.connect(
-        auth_url=auth_url,
-        project_name=project_name,
-        username=username,
-        password=password,
-        region_name=region_name,
-        user_domain_name=user_domain_name,
-        project_domain_name=project_domain_name,
-        interface=interface,
-        endpoint_type=endpoint_type
-    )
-
-
-def _connect_to_gateway(gateway_username, gateway_ip, gateway_port, ssh_key_path):
+from console_log import ConsoleLog
+from openstack_connection import create_openstack_connection, get_auth_config
+from readiness import WaitTimeout, wait_for_status, wait_until
+
+# Every fact is printed after a marker line with its name, so all facts are read in one round trip
+FACT_MARKER = "@@fact "
+FACT_COMMANDS = {
+    "interfaces": "/usr/sbin/ip -4 -o a | awk '{print $2}'",
+    "hostname": "hostname",
+    "partition_table": "/usr/sbin/gdisk -l",
+    "block_devices": "lsblk",
+    "cloud_init": "cloud-init status --long",
+    "ping": 'ping_out=$(ping -c 5 google.com) && echo "$ping_out" || echo -1',
+}
+
+
+def _facts_script():
+    return "\n".join(f"echo '{FACT_MARKER}{name}'; {{ {command}; }} 2>&1" for name, command in FACT_COMMANDS.items())
+
+
+def _parse_facts(output):
+    facts = dict()
+    name = None
+    for line in output.splitlines():
+        if line.startswith(FACT_MARKER):
+            name = line[len(FACT_MARKER):].strip()
+            facts[name] = []
+        elif name is not None:
+            facts[name].append(line)
+    return {name: "\n".join(lines).strip() for name, lines in facts.items()}
+
+
+def connect_to_gateway(gateway_username, gateway_ip, gateway_port, ssh_key_path):
     gateway = Connection(host=gateway_ip, user=gateway_username,
                          connect_kwargs={"key_filename": ssh_key_path},
                          port=gateway_port, forward_agent=True)
@@ -32,91 +44,91 @@ class VmTestActions:
     def __init__(self, gateway_username, gateway_ip, gateway_port, server_username, server_ip, ssh_key_path, server_id,
                  network_id, extra_volume_id):
         self.vmC = None
+        self._facts = None
         self.ssh_parameters = {"gateway_username": gateway_username, "gateway_ip": gateway_ip,
                                "gateway_port": gateway_port, "server_username": server_username, "server_ip": server_ip,
                                "ssh_key_path": ssh_key_path}
         self._prepare_ssh_connection(**self.ssh_parameters)
-        self.auth_config = {"auth_url": None, "region_name": None, "project_name": None, "username": None,
-                            "password": None, "user_domain_name": "Default", "project_domain_name": "Default",
-                            "interface": "public", "endpoint_type": "publicURL"}
-        self._set_auth_config()
-        self.conn = _create_openstack_connection(**self.auth_config)
+        self.auth_config = get_auth_config()
+        self.conn = create_openstack_connection(**self.auth_config)
         self.stage_info = {"server_id": server_id, "network_id": network_id, "extra_volume_id": extra_volume_id}
-
-    def _set_auth_config(self):
-        for k in self.auth_config.keys():
-            if os.getenv(k) is not None:
-                self.auth_config[k] = os.getenv(k)
+        self.console_log = ConsoleLog(self.conn, server_id)
 
     def _prepare_ssh_connection(self, gateway_username, gateway_ip, gateway_port, server_username, server_ip,
                                 ssh_key_path):
-        gateway = _connect_to_gateway(gateway_username, gateway_ip, gateway_port, ssh_key_path)
-        time.sleep(30)
-        count = 10
-        ssh_service_started = False
-        while not ssh_service_started and count > 0:
-            try:
-                result = gateway.run("nc -zv " + server_ip + " 22")
-                ssh_service_started = True
-            except:
-                time.sleep(6)
-                count -= 1
-        if not ssh_service_started:
+        gateway = connect_to_gateway(gateway_username, gateway_ip, gateway_port, ssh_key_path)
+        try:
+            wait_until(f"ssh service on {server_ip}", lambda: gateway.run("nc -zv " + server_ip + " 22", hide=True),
+                       timeout=300, max_delay=10)
+        except WaitTimeout:
             print("ssh service on abrack is not started")
             exit(1)
         self.vmC = Connection(user=server_username, host=server_ip, gateway=gateway,
                               connect_kwargs={"key_filename": ssh_key_path})
+        self._facts = None
+
+    def get_facts(self):
+        """
+        Collect the facts of the guest with one remote script, the snapshot is kept until an action
+        changes the server
+        """
+        if self._facts is None:
+            result = self.vmC.run(_facts_script(), hide=True, warn=True)
+            self._facts = _parse_facts(result.stdout)
+        return self._facts
 
     def get_interfaces_name(self):
-        interfaces = self.vmC.run("/usr/sbin/ip -4 -o a | awk '{print $2}'", hide=True)
-        return interfaces.stdout.strip()
+        return self.get_facts()["interfaces"]
 
     def get_hostname(self):
-        hostname = self.vmC.run("hostname", hide=True)
-        return hostname.stdout.strip()
+        return self.get_facts()["hostname"]
 
     def ping_internet(self):
-        error = False
-        try:
-            ping_out = self.vmC.run("ping -c 5 google.com", hide=True)
-        except:
-            error = True
-        if error:
-            return "-1"
-        else:
-            return ping_out.stdout.strip()
+        return self.get_facts()["ping"]
 
     def get_partition_table(self):
-        pt = self.vmC.run("/usr/sbin/gdisk -l", hide=True)
-        return pt.stdout.strip()
+        return self.get_facts()["partition_table"]
+
+    def get_block_devices(self):
+        return self.get_facts()["block_devices"]
+
+    def get_cloud_init_status(self):
+        return self.get_facts()["cloud_init"]
 
     def get_console_log(self):
-        console_log = self.conn.compute.get_server_console_output(self.stage_info['server_id'], length=None)
-        return console_log['output']
+        self.console_log.read()
+        return self.console_log.text
 
     def add_server_to_private_network(self):
-        self.conn.compute.create_server_interface(self.stage_info["server_id"], net_id=self.stage_info["network_id"])
-        time.sleep(20)
-        count = 5
-        result = None
-        while count > 0:
-            try:
-                eth1_interface = self.vmC.run("/usr/sbin/ip a | grep eth1", hide=True)
-                result = eth1_interface.stdout.strip()
-                break
-            except:
-                count -= 1
-                time.sleep(10)
-        if count == 0:
-            result = "-1"
-        return result
+        interface = self.conn.compute.create_server_interface(self.stage_info["server_id"],
+                                                              net_id=self.stage_info["network_id"])
+        self._facts = None
+        try:
+            wait_for_status("private network interface", lambda: self.conn.network.get_port(interface.port_id),
+                            "ACTIVE", timeout=120)
+            return wait_until("eth1 in guest", lambda: self._guest_output("/usr/sbin/ip a | grep eth1", " UP "),
+                              timeout=120)
+        except WaitTimeout:
+            return "-1"
 
     def add_extra_volume_to_server(self):
         self.conn.compute.create_volume_attachment(server=self.stage_info["server_id"],
                                                    volume=self.stage_info["extra_volume_id"])
-        time.sleep(10)
-        disk = self.vmC.run("lsblk | grep vdb", hide=True)
-        return disk.stdout.strip()
+        self._facts = None
+        try:
+            wait_for_status("extra volume attachment",
+                            lambda: self.conn.block_storage.get_volume(self.stage_info["extra_volume_id"]), "in-use",
+                            timeout=120, failed_status=("error", "error_attaching"))
+            return wait_until("vdb in guest", lambda: self._guest_output("lsblk | grep vdb", "vdb"), timeout=120)
+        except WaitTimeout:
+            return "-1"
+
+    def _guest_output(self, command, expected):
+        """
+        Run a command on the server, its output is returned when it holds the expected text
+        """
+        output = self.vmC.run(command, hide=True).stdout.strip()
+        return output if expected in output else None
 
     def resize_server(self):
         server_id = self.stage_info["server_id"]